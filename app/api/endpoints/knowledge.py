@@ -1,25 +1,38 @@
 # app/api/endpoints/knowledge.py
 import logging
 from uuid import UUID
-from fastapi import APIRouter, HTTPException, status, Path
+from fastapi import APIRouter, status, Path, BackgroundTasks
 from ...api import schemas # We'll need to add the new schema here
 from ...services import knowledge_service
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/tenants/{tenant_id}/knowledge", tags=["Knowledge Base"])
 
-@router.post("/text", status_code=status.HTTP_201_CREATED, summary="Ingest raw text into the knowledge base")
+@router.post("/text", status_code=status.HTTP_202_ACCEPTED, summary="Ingest raw text into the knowledge base")
 def add_text_knowledge(
     request_data: schemas.KnowledgeIngestRequest, # The new Pydantic schema
+    background_tasks: BackgroundTasks,
     tenant_id: UUID = Path(..., description="The UUID of the tenant")
 ):
+    """
+    Queues the text for ingestion and returns immediately. AI chunking, batch
+    embedding and the bulk insert run after the response has been sent.
+    """
+    background_tasks.add_task(ingest_knowledge_in_background, tenant_id, request_data.text_content, request_data.source_name)
+    logger.info("API: Queued knowledge ingestion of '%s' for tenant %s.", request_data.source_name, tenant_id)
+    return {"status": "queued", "message": "Knowledge ingestion has been queued."}
+
+def ingest_knowledge_in_background(tenant_id: UUID, text_content: str, source_name: str):
+    """
+    This function is run in the background. Errors can no longer reach the client,
+    so they are logged here.
+    """
     try:
         chunk_count = knowledge_service.ingest_text_knowledge(
             tenant_id=tenant_id,
-            text_content=request_data.text_content,
-            source_name=request_data.source_name
+            text_content=text_content,
+            source_name=source_name
         )
-        return {"message": "Knowledge ingested successfully.", "chunks_created": chunk_count}
+        logger.info("BACKGROUND TASK: Knowledge '%s' ingested for tenant %s. Chunks created: %s", source_name, tenant_id, chunk_count)
     except Exception as e:
-        logger.error(f"API Error ingesting knowledge for tenant {tenant_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail="Failed to ingest knowledge.")
\ No newline at end of file
+        logger.error("BACKGROUND TASK: Error ingesting knowledge for tenant %s: %s", tenant_id, e, exc_info=True)
@@ -4,6 +4,7 @@ from uuid import UUID
 from fastapi import APIRouter, HTTPException, status, Path
 from ... import db
 from ...api import schemas
+from ...utils.responses import row_response
 # Import our new, powerful services
 from ...services import openai_service, product_service, tagging_service, menu_ingestion_service
 
@@ -17,8 +18,9 @@ router = APIRouter(
 
 @router.post(
     		"/",
-    response_model=schemas.ProductRead,
+    response_model=None,
     status_code=status.HTTP_201_CREATED,
+    responses={201: {"model": schemas.ProductRead}},
     summary="Create a product with AI-driven description and tagging"
 )
 def create_product( # Removed async as supabase-py v1 is sync
@@ -30,65 +32,75 @@ def create_product( # Removed async as supabase-py v1 is sync
     1.  Generates a rich, synthetic description.
     2.  Generates a vector embedding from the synthetic description.
     3.  Uses AI to suggest and reconcile a de-duplicated list of tags.
-    4.  Creates the product and its tag associations in the database.
+    4.  Creates the product and its tag associations in a single DB call.
     """
-    logger.info(f"API: Received request to add product '{product_data.product_name}'")
+    logger.info("API: Received request to add product '%s'", product_data.product_name)
     
-    logger.info(f"--- PRODUCT CREATION WORKFLOW STARTED for '{product_data.product_name}' ---")
+    logger.info("--- PRODUCT CREATION WORKFLOW STARTED for '%s' ---", product_data.product_name)
 
 
     try:
         # Step 1: AI Enrichment
-        logger.info("[STEP 1/5] Generating synthetic description with Gemini...")
+        logger.info("[STEP 1/4] Generating synthetic description with Gemini...")
 
         synthetic_desc = product_service.generate_synthetic_description(
             product_data.product_name,
             product_data.description
         )
-        logger.info(f"[STEP 1/5] Synthetic description generated: '{synthetic_desc[:100]}...'")
+        logger.info("[STEP 1/4] Synthetic description generated: '%s...'", synthetic_desc[:100])
 
         # Step 2: Embedding
-        logger.info("[STEP 2/5] Generating product embedding with OpenAI...")
+        logger.info("[STEP 2/4] Generating product embedding with OpenAI...")
         product_embedding = openai_service.get_embedding(synthetic_desc)
-        logger.info("[STEP 2/5] Product embedding created successfully.")
+        logger.info("[STEP 2/4] Product embedding created successfully.")
 
-        # Step 3: Insert Product (without tags first)
-        logger.info("[STEP 3/5] Inserting product into database...")
-        product_dict = product_data.model_dump()
-        product_dict['tenant_id'] = str(tenant_id)
-        product_dict['description_embedding'] = product_embedding
-        # Add a new column for the generated description to 'products' table:
-        # ALTER TABLE products ADD COLUMN generated_description TEXT;
-        product_dict['generated_description'] = synthetic_desc
-
-        product_res = db.supabase.table('products').insert(product_dict).execute()
-        if not product_res.data:
-            raise HTTPException(status_code=400, detail="DB Error: Failed to create product.")
-        
-        new_product = product_res.data[0]
-        new_product_id = new_product['id']
-        logger.info(f"DB: Product '{new_product_id}' created.")
-        logger.info(f"[STEP 3/5] Product '{new_product_id}' created successfully in DB.")
-
-        # Step 4: Intelligent Tagging
+        # Step 3: Intelligent Tagging (only needs the name, description and embedding)
+        logger.info("[STEP 3/4] Suggesting and reconciling tags...")
         final_tag_ids = tagging_service.suggest_and_reconcile_tags(
             tenant_id,
-            new_product['product_name'],
+            product_data.product_name,
             synthetic_desc,
             product_embedding,
         )
 
-        # Step 5: Associate Tags
-        if final_tag_ids:
-            associations = [{"product_id": new_product_id, "tag_id": str(tag_id)} for tag_id in final_tag_ids]
-            db.supabase.table('product_tag_associations').insert(associations).execute()
-            logger.info(f"DB: Associated {len(final_tag_ids)} tags with product '{new_product_id}'.")
-        
-        return new_product
+        # Step 4: Insert Product + Tag Associations in a single round-trip
+        logger.info("[STEP 4/4] Inserting product and tag associations into database...")
+        product_dict = product_service.build_product_row(tenant_id, product_data, synthetic_desc, product_embedding)
+
+        # DB function that performs both inserts inside one transaction:
+        # CREATE FUNCTION create_product_with_tags(p_product jsonb, p_tag_ids uuid[])
+        # RETURNS SETOF products AS $$
+        # DECLARE new_row products;
+        # BEGIN
+        #   INSERT INTO products (tenant_id, product_name, description, list_price, floor_price,
+        #                         image_url, is_active, description_embedding, generated_description)
+        #   SELECT r.tenant_id, r.product_name, r.description, r.list_price, r.floor_price,
+        #          r.image_url, r.is_active, r.description_embedding, r.generated_description
+        #   FROM jsonb_populate_record(NULL::products, p_product) r
+        #   RETURNING * INTO new_row;
+        #   INSERT INTO product_tag_associations (product_id, tag_id)
+        #   SELECT new_row.id, unnest(p_tag_ids);
+        #   RETURN NEXT new_row;
+        # END; $$ LANGUAGE plpgsql;
+        product_res = db.supabase.rpc('create_product_with_tags', {
+            'p_product': product_dict,
+            'p_tag_ids': final_tag_ids # Already UUID strings, straight from PostgREST
+        }).execute()
+        if not product_res.data:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="DB Error: Failed to create product.")
+
+        new_product = product_res.data[0]
+        new_product_id = new_product['id']
+        logger.info("DB: Product '%s' created with %s tag associations.", new_product_id, len(final_tag_ids))
+        logger.info("[STEP 4/4] Product '%s' created successfully in DB.", new_product_id)
+
+        return row_response(new_product, schemas.ProductRead, status.HTTP_201_CREATED)
 
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"API Error adding product: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail="Internal server error.")
+        logger.error("API Error adding product: %s", e, exc_info=True)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal server error.")
     
 @router.post(
     "/batch-from-text",
@@ -107,7 +119,7 @@ def create_products_from_text(
     # For the MVP, we can run it synchronously and let the client wait.
     # In a future sprint, we would queue this in a `batch_tasks` queue.
     
-    logger.info(f"API: Received request to ingest menu text for tenant {tenant_id}.")
+    logger.info("API: Received request to ingest menu text for tenant %s.", tenant_id)
     
     try:
         result = menu_ingestion_service.ingest_menu_from_text(
@@ -116,5 +128,5 @@ def create_products_from_text(
         )
         return result
     except Exception as e:
-        logger.error(f"API Error ingesting menu text: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail="Failed to process menu text.")
\ No newline at end of file
+        logger.error("API Error ingesting menu text: %s", e, exc_info=True)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to process menu text.")
\ No newline at end of file
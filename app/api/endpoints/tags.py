@@ -4,6 +4,7 @@ from uuid import UUID
 from fastapi import APIRouter, HTTPException, status, Path
 from ... import db
 from ...api import schemas
+from ...utils.responses import row_response
 from ...services import openai_service # We need the embedding service here
 
 logger = logging.getLogger(__name__)
@@ -13,7 +14,7 @@ router = APIRouter(
     tags=["Tags"]
 )
 
-@router.post("/", response_model=schemas.TagRead, status_code=status.HTTP_201_CREATED, summary="Create a new tag with its embedding")
+@router.post("/", response_model=None, status_code=status.HTTP_201_CREATED, responses={201: {"model": schemas.TagRead}}, summary="Create a new tag with its embedding")
 def create_tag(
     tag_data: schemas.TagCreate,
     tenant_id: UUID = Path(..., description="The UUID of the tenant this tag belongs to")
@@ -23,10 +24,10 @@ def create_tag(
     """
     try:
         tag_name_lower = tag_data.tag_name.lower()
-        logger.info(f"Attempting to create tag '{tag_name_lower}' for tenant {tenant_id}")
+        logger.info("Attempting to create tag '%s' for tenant %s", tag_name_lower, tenant_id)
 
-        # Generate embedding for the new tag name
-        tag_embedding = openai_service.get_embedding(tag_name_lower)
+        # Generate embedding for the new tag name (tag names repeat a lot, so it's cached)
+        tag_embedding = openai_service.get_cached_embedding(tag_name_lower)
 
         tag_dict = {
             "tenant_id": str(tenant_id),
@@ -37,22 +38,26 @@ def create_tag(
         response = db.supabase.table('product_tags').insert(tag_dict).execute()
 
         if response.data is None:
+            error = response.error
             # Check for unique violation
-            if response.error and '23505' in response.error.code:
+            if error and error.code == '23505':
                  raise HTTPException(
                     status_code=status.HTTP_409_CONFLICT,
                     detail=f"Tag '{tag_name_lower}' already exists for this tenant."
                 )
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Could not create tag. Supabase error: {response.error.message if response.error else 'Unknown'}"
+                detail=f"Could not create tag. Supabase error: {error.message if error else 'Unknown'}"
             )
         
         created_tag = response.data[0]
-        logger.info(f"Successfully created tag '{created_tag['tag_name']}' with ID: {created_tag['id']}")
+        logger.info("Successfully created tag '%s' with ID: %s", created_tag['tag_name'], created_tag['id'])
 
-        return created_tag
+        return row_response(created_tag, schemas.TagRead, status.HTTP_201_CREATED)
 
+    except HTTPException:
+        # Let the 409/400 above through instead of masking them as a 500
+        raise
     except Exception as e:
-        logger.error(f"An unexpected error occurred while creating tag: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail="An internal server error occurred.")
\ No newline at end of file
+        logger.error("An unexpected error occurred while creating tag: %s", e, exc_info=True)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An internal server error occurred.")
\ No newline at end of file
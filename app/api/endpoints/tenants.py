@@ -2,6 +2,7 @@ import logging
 from fastapi import APIRouter, HTTPException, status
 from ... import db  # Imports the initialized Supabase client
 from .. import schemas # Imports our Pydantic models
+from ...utils.responses import row_response
 
 # Initialize a logger for this module
 logger = logging.getLogger(__name__)
@@ -14,11 +15,12 @@ router = APIRouter(
 
 @router.post(
     "/",
-    response_model=schemas.tenantRead,
+    response_model=None,
     status_code=status.HTTP_201_CREATED,
+    responses={201: {"model": schemas.tenantRead}},
     summary="Create a new tenant"
 )
-async def create_tenant(tenant_data: schemas.tenantCreate):
+def create_tenant(tenant_data: schemas.tenantCreate): # Sync: supabase-py blocks, so let FastAPI run it in the threadpool
     """
     Registers a new tenant on the platform.
 
@@ -28,35 +30,33 @@ async def create_tenant(tenant_data: schemas.tenantCreate):
     - **system_prompt**: The base personality prompt for the AI assistant.
     """
     try:	
-        logger.info(f"Attempting to create tenant: {tenant_data.tenant_name}")
+        logger.info("Attempting to create tenant: %s", tenant_data.tenant_name)
 
-        # The .dict() method is deprecated, use .model_dump()
-        # Pydantic V2 uses model_dump(), V1 uses dict()
-        tenant_dict = tenant_data.model_dump()
+        # The schema is flat, so a shallow copy of the validated fields is all we
+        # need; it skips a full pass through pydantic-core's serializer (model_dump()).
+        tenant_dict = dict(tenant_data)
 
         # Insert the data into the 'businesses' table
         response = db.supabase.table('businesses').insert(tenant_dict).execute()
 
         # Check for errors from Supabase
         if response.data is None:
-            logger.error(f"Supabase error creating tenant: {response.error.message if response.error else 'Unknown error'}")
+            logger.error("Supabase error creating tenant: %s", response.error.message if response.error else 'Unknown error')
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail=f"Could not create tenant. Supabase error: {response.error.message if response.error else 'Unknown'}"
             )
         
         created_tenant = response.data[0]
-        logger.info(f"Successfully created tenant with ID: {created_tenant['id']}")
+        logger.info("Successfully created tenant with ID: %s", created_tenant['id'])
 
-        # Pydantic will automatically validate that the returned data
-        # matches the tenantRead schema.
-        return created_tenant
+        return row_response(created_tenant, schemas.tenantRead, status.HTTP_201_CREATED)
 
     except HTTPException as http_exc:
         # Re-raise HTTPException to be handled by FastAPI
         raise http_exc
     except Exception as e:
-        logger.error(f"An unexpected error occurred while creating tenant: {e}", exc_info=True)
+        logger.error("An unexpected error occurred while creating tenant: %s", e, exc_info=True)
         # For any other unexpected errors, return a generic 500 error
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
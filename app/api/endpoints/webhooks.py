@@ -1,5 +1,7 @@
+import hmac
 import logging
-from fastapi import APIRouter, HTTPException, status, Request, Response, Query, BackgroundTasks
+import orjson
+from fastapi import APIRouter, HTTPException, status, Request, Response, BackgroundTasks
 from ... import db
 from ...config import Config
 
@@ -11,13 +13,13 @@ def verify_whatsapp_webhook(
 				request: Request
 ):
 				"""Handles Meta's webhook verification challenge."""
-				logger.info("Received GET request for WhatsApp webhook verification.")
-				verify_token = request.query_params.get("hub.verify_token")
+				query_params = request.query_params
+				verify_token = query_params.get("hub.verify_token")
 				
-				if verify_token == Config.VERIFY_TOKEN:
+				# Constant-time comparison so the token can't be recovered through response timing.
+				if verify_token and Config.VERIFY_TOKEN and hmac.compare_digest(verify_token.encode(), Config.VERIFY_TOKEN.encode()):
 								logger.info("Verification token matched.")
-								challenge = request.query_params.get("hub.challenge")
-								return Response(content=challenge, media_type="text/plain", status_code=200)
+								return Response(content=query_params.get("hub.challenge"), media_type="text/plain", status_code=200)
 				
 				logger.warning("Verification token mismatch.")
 				raise HTTPException(status_code=403, detail="Invalid verification token.")
@@ -52,9 +54,10 @@ async def handle_whatsapp_events(request: Request, background_tasks: BackgroundT
 				Receives events from Meta, immediately queues feedback and processing tasks,
 				and returns 200 OK.
 				"""
-				data = await request.json()
+				data = orjson.loads(await request.body())
 				
-				logger.info(f"Message received: {data}")
+				if logger.isEnabledFor(logging.DEBUG):
+								logger.debug("Message received: %s", data)
 				
 				# We use FastAPI's BackgroundTasks to ensure we respond to Meta instantly.
 				background_tasks.add_task(queue_events, data)
@@ -68,40 +71,43 @@ def queue_events(data: dict):
 				"""
 				logger.info("--- BACKGROUND TASK: Queuing events from webhook ---")
 				
+				# We only process user-sent messages. Pull the three fields we need in one pass;
+				# anything else Meta sends to this webhook (delivery/read status updates, other
+				# objects) is missing one of these paths and is dropped here.
+				if data.get("object") != "whatsapp_business_account":
+								return
 				try:
-								# We only process user-sent text messages
-								if (data.get("object") == "whatsapp_business_account" and
-																data["entry"][0]["changes"][0]["value"].get("messages")):
-												
-												value = data['entry'][0]['changes'][0]['value']
-												message_id = value['messages'][0]['id']
-												tenant_phone_id = value['metadata']['phone_number_id']
+								value = data["entry"][0]["changes"][0]["value"]
+								message_id = value["messages"][0]["id"]
+								tenant_phone_id = value["metadata"]["phone_number_id"]
+				except (KeyError, IndexError, TypeError):
+								logger.debug("Webhook payload carries no inbound message. Ignoring.")
+								return
 
-												# Find our internal tenant_id from the phone_number_id
-												tenant_res = db.supabase.table('businesses').select('id').eq('whatsapp_phone_number_id', tenant_phone_id).single().execute()
-												if not tenant_res.data:
-																logger.error(f"Webhook received for unknown tenant phone ID: {tenant_phone_id}. Ignoring.")
-																return
-												
-												tenant_id = tenant_res.data['id']
-												
-												# --- Queue BOTH events ---
-												
-												# Event A: The immediate read receipt
-												read_receipt_event = {
-																"event_type": "send_read_receipt",
-																"payload": {"tenant_id": str(tenant_id), "message_id": message_id}
-												}
-												db.supabase.table('event_dispatcher').insert(read_receipt_event).execute()
-												logger.info("Queued 'send_read_receipt' event.")
-
-												# Event B: The main processing task
-												processing_event = {
-																"event_type": "new_inbound_message",
-																"payload": data
-												}
-												db.supabase.table('event_dispatcher').insert(processing_event).execute()
-												logger.info("Queued 'new_inbound_message' event.")
-												
+				try:
+								# Resolve the tenant and queue BOTH events (read receipt + main processing task)
+								# in one round-trip. The DB function does the lookup and both inserts in one transaction:
+								# CREATE FUNCTION queue_whatsapp_events(p_phone_number_id text, p_message_id text, p_payload jsonb)
+								# RETURNS uuid AS $$
+								# DECLARE t uuid;
+								# BEGIN
+								#   SELECT id INTO t FROM businesses WHERE whatsapp_phone_number_id = p_phone_number_id;
+								#   IF t IS NULL THEN RETURN NULL; END IF;
+								#   INSERT INTO event_dispatcher (event_type, payload) VALUES
+								#     ('send_read_receipt', jsonb_build_object('tenant_id', t, 'message_id', p_message_id)),
+								#     ('new_inbound_message', p_payload);
+								#   RETURN t;
+								# END; $$ LANGUAGE plpgsql;
+								res = db.supabase.rpc('queue_whatsapp_events', {
+												'p_phone_number_id': tenant_phone_id,
+												'p_message_id': message_id,
+												'p_payload': data
+								}).execute()
+								if not res.data:
+												logger.error("Webhook received for unknown tenant phone ID: %s. Ignoring.", tenant_phone_id)
+												return
+								
+								logger.info("Queued 'send_read_receipt' and 'new_inbound_message' events.")
+								
 				except Exception as e:
-								logger.error(f"Background task failed to queue events: {e}", exc_info=True)
\ No newline at end of file
+								logger.error("Background task failed to queue events: %s", e, exc_info=True)
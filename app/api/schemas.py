@@ -1,9 +1,8 @@
 # app/api/schemas.py
 
-from pydantic import BaseModel, UUID4, Field, model_validator
-from typing import Optional, List
+from pydantic import BaseModel, ConfigDict, UUID4, Field, model_validator
+from typing import Optional, List, Literal, Dict, Any
 from datetime import datetime
-from enum import Enum
 
 # ===================================================================
 #                       tenant Schemas
@@ -22,8 +21,7 @@ class tenantRead(tenantBase):
     id: UUID4
     created_at: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # ===================================================================
 #                         Tag Schemas
@@ -38,8 +36,7 @@ class TagCreate(TagBase):
 class TagRead(TagBase):
     id: UUID4
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 # ===================================================================
@@ -64,8 +61,7 @@ class ProductRead(ProductBase):
     # We can enrich this later to show associated tags.
     # associated_tags: List[TagRead] = [] 
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 # ===================================================================
@@ -83,8 +79,7 @@ class KnowledgeRead(KnowledgeBase):
     id: UUID4
     tenant_id: UUID4
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 # ===================================================================
@@ -108,19 +103,20 @@ class PromotionCreate(PromotionBase):
         """
         Validates that EITHER 'discount_percentage' OR 'discount_amount' is set, but not both or neither.
         """
-        if (self.discount_percentage is not None) and (self.discount_amount is not None):
+        # Exactly one of the two must be set, so a single XOR covers the happy path.
+        has_percentage = self.discount_percentage is not None
+        if has_percentage ^ (self.discount_amount is not None):
+            return self
+        if has_percentage:
             raise ValueError("Provide either 'discount_percentage' or 'discount_amount', not both.")
-        if (self.discount_percentage is None) and (self.discount_amount is None):
-            raise ValueError("Either 'discount_percentage' or 'discount_amount' must be provided.")
-        return self
+        raise ValueError("Either 'discount_percentage' or 'discount_amount' must be provided.")
 
 class PromotionRead(PromotionBase):
     """Schema for returning promotion data."""
     id: UUID4
     tenant_id: UUID4
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
         
 
 # In app/api/schemas.py
@@ -138,11 +134,9 @@ class ToolCallArgument(BaseModel):
     category: Optional[str] = None
     reason: Optional[str] = None
 
-# Step 1: Define the Enum of all valid tool names
-class ToolName(str, Enum):
-    QUEUE_FOR_PROFILING = "queue_for_profiling"
-    REQUEST_HUMAN_INTERVENTION = "request_human_intervention"
-    LOOKUP_PRODUCT_INFO = "lookup_product_info"
+# All valid tool names. A Literal validates as a plain string set check and keeps
+# `name` a str, so it compares directly against the names below.
+ToolName = Literal["queue_for_profiling", "request_human_intervention", "lookup_product_info"]
 
 class ToolCall(BaseModel):
     name: ToolName
@@ -165,3 +159,65 @@ class KnowledgeIngestRequest(BaseModel):
     
 class MenuIngestRequest(BaseModel):
     menu_text: str
+
+
+# ===================================================================
+#                  WhatsApp Inbound Message Schemas
+# ===================================================================
+# Only the fields we read from a Cloud API "messages" webhook; everything else
+# Meta sends is ignored so new fields don't break parsing.
+
+class _WhatsAppModel(BaseModel):
+    model_config = ConfigDict(extra='ignore')
+
+class WhatsAppProfile(_WhatsAppModel):
+    name: str
+
+class WhatsAppContact(_WhatsAppModel):
+    wa_id: str
+    profile: WhatsAppProfile
+
+class WhatsAppText(_WhatsAppModel):
+    body: str
+
+class WhatsAppMessage(_WhatsAppModel):
+    text: WhatsAppText
+
+class WhatsAppMetadata(_WhatsAppModel):
+    phone_number_id: str
+
+class WhatsAppValue(_WhatsAppModel):
+    metadata: WhatsAppMetadata
+    contacts: List[WhatsAppContact]
+    messages: List[WhatsAppMessage]
+
+class WhatsAppChange(_WhatsAppModel):
+    value: WhatsAppValue
+
+class WhatsAppEntry(_WhatsAppModel):
+    changes: List[WhatsAppChange]
+
+class WhatsAppInbound(_WhatsAppModel):
+    entry: List[WhatsAppEntry]
+
+    @property
+    def value(self) -> WhatsAppValue:
+        """The single change a message webhook carries."""
+        return self.entry[0].changes[0].value
+
+# ===================================================================
+#                    Realtime Task Payload Schemas
+# ===================================================================
+# Payloads the worker reads from realtime_tasks; validated once on entry.
+
+class ReadReceiptTask(BaseModel):
+    tenant_id: str = Field(..., min_length=1)
+    message_id: str = Field(..., min_length=1)
+
+class OutboundConfig(BaseModel):
+    tenant_id: str = Field(..., min_length=1)
+    channel: str = Field(..., min_length=1)
+
+class OutboundTask(BaseModel):
+    config: OutboundConfig
+    data: Dict[str, Any] = Field(..., min_length=1)
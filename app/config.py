@@ -29,4 +29,13 @@ class Config:
     
 				# Default to False for production safety
     DEV_MODE: bool = os.getenv("DEV_MODE", "false").lower() in ('true', '1', 't')
-    
+
+    # Max concurrent sync request handlers (FastAPI runs `def` endpoints in anyio's threadpool, default 40)
+    API_THREADPOOL_SIZE: int = int(os.getenv("API_THREADPOOL_SIZE", "200"))
+
+    # How many recent conversation turns the query-refinement prompt sees
+    REFINE_HISTORY_TURNS: int = int(os.getenv("REFINE_HISTORY_TURNS", "6"))
+
+    # Per-process caps on in-flight provider calls, so bursts queue locally instead of hitting rate limits
+    GEMINI_MAX_CONCURRENCY: int = int(os.getenv("GEMINI_MAX_CONCURRENCY", "16"))
+    OPENAI_MAX_CONCURRENCY: int = int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
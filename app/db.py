@@ -1,9 +1,27 @@
 # /app/db.py
-from supabase import create_client, Client
+import httpx
+from supabase import create_client, Client, ClientOptions
 from .config import Config
 
 if not Config.SUPABASE_KEY or not Config.SUPABASE_URL or not Config.SUPABASE_SECRET:
 	raise ValueError("SUPABASE_URL and SUPABASE_KEY must be set in the environment.")
 
-supabase: Client = create_client(Config.SUPABASE_URL, Config.SUPABASE_KEY)
-supabase_admin: Client = create_client(Config.SUPABASE_URL, Config.SUPABASE_SECRET)
\ No newline at end of file
+# One pooled, keep-alive HTTP session per client, so PostgREST calls reuse warm
+# TCP/TLS connections instead of re-handshaking. Each client needs its own session:
+# postgrest writes the client's apikey/Authorization headers onto the session it is
+# given, so a shared one would send anon requests with the service key.
+# Idle connections are kept for a minute so a quiet worker still finds them warm;
+# the transport retries failed connects (not requests) so a dropped pooler
+# connection doesn't fail the task. Reads keep postgrest's 120s default for bulk inserts.
+def _pooled_http_client() -> httpx.Client:
+	return httpx.Client(
+		transport=httpx.HTTPTransport(
+			http2=True,
+			limits=httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=60),
+			retries=2,
+		),
+		timeout=httpx.Timeout(120.0, connect=3.0),
+	)
+
+supabase: Client = create_client(Config.SUPABASE_URL, Config.SUPABASE_KEY, options=ClientOptions(httpx_client=_pooled_http_client()))
+supabase_admin: Client = create_client(Config.SUPABASE_URL, Config.SUPABASE_SECRET, options=ClientOptions(httpx_client=_pooled_http_client()))
\ No newline at end of file
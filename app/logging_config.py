@@ -1,5 +1,8 @@
 # app/logging_config.py
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys
 
 def setup_logging():
@@ -28,8 +31,14 @@ def setup_logging():
         # Set the formatter for the handler
         console_handler.setFormatter(formatter)
         
-        # Add the handler to the root logger
-        root_logger.addHandler(console_handler)
+        # Don't write to stdout on the calling thread: request/worker threads only
+        # enqueue the record, and a background listener thread owns the real handler.
+        log_queue = queue.SimpleQueue()
+        root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        listener = logging.handlers.QueueListener(log_queue, console_handler, respect_handler_level=True)
+        listener.start()
+        # Flush whatever is still queued on shutdown
+        atexit.register(listener.stop)
         
         root_logger.info("Logging configured successfully.")
     else:
@@ -1,4 +1,7 @@
+from contextlib import asynccontextmanager
+from anyio import to_thread
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from . import config # This will run the checks in config.py on startup
 from .api.endpoints import tenants, tags, products, webhooks, knowledge
 
@@ -8,11 +11,24 @@ from .logging_config import setup_logging
 # Call the setup function right at the start
 setup_logging()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Process startup/shutdown hook.
+    Our endpoints are sync (supabase-py, OpenAI and Gemini calls all block), so FastAPI
+    runs each one on a worker thread. Raise the threadpool ceiling so concurrent
+    requests waiting on network I/O don't queue behind the default 40 threads.
+    """
+    to_thread.current_default_thread_limiter().total_tokens = config.Config.API_THREADPOOL_SIZE
+    yield
+
 # Create the FastAPI app instance
 app = FastAPI(
     title="Astro Engagement Engine",
     description="The core API for the Astro multi-channel user engagement platform.",
-    version="0.1.0"
+    version="0.1.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse # orjson encodes responses several times faster than stdlib json
 )
 
 # A simple root endpoint to confirm the server is running
@@ -1,5 +1,7 @@
 # app/services/gemini_service.py
 import logging
+import threading
+from functools import lru_cache
 from google import genai
 from google.genai import types
 from ..config import Config
@@ -22,17 +24,25 @@ except Exception as e:
     logger.critical(f"FATAL: Could not configure Gemini client: {e}")
     client = None
 
+# Bounds in-flight Gemini calls across all threads (API thread pool, tagging and
+# ingestion executors) so a burst waits here rather than tripping the RPM limit.
+_inflight = threading.BoundedSemaphore(Config.GEMINI_MAX_CONCURRENCY)
+
+# Plain text generation never uses thinking; build that config once and share it.
+_NO_THINK_CFG = types.GenerateContentConfig(thinking_config=types.ThinkingConfig(thinking_budget=0))
+
 def generate_text(prompt: str) -> str | None:
     """Generates a text response for a simple, single-turn prompt."""
     if not client:
         logger.error("Gemini model is not available.")
         return None
     try:
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-												contents=prompt,
-												config=types.GenerateContentConfig(thinking_config=types.ThinkingConfig(thinking_budget=0)),
-								)
+        with _inflight:
+            response = client.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=prompt,
+                config=_NO_THINK_CFG,
+            )
         # Add safety checks for the response
         if not response.text:
             logger.warning("Gemini response is empty.")
@@ -43,29 +53,34 @@ def generate_text(prompt: str) -> str | None:
         return None
     
 
-def think_and_generate_json(prompt: str, response_schema: Type[T]) -> T | None:
+@lru_cache(maxsize=None)
+def _json_config(response_schema: Type[BaseModel]) -> types.GenerateContentConfig:
+    """
+    JSON-mode generation config for a schema. Schemas are module-level classes, so
+    each one gets a single config object that is reused across calls.
+    """
+    return types.GenerateContentConfig(
+        response_mime_type="application/json",
+        response_schema=response_schema,
+    )
+
+
+def think_and_generate_json(prompt: str, response_schema: Type[T], model: str = 'gemini-1.5-flash') -> T | None:
     """
     Generates a response from Gemini, constrained to a specific Pydantic schema.
-    Returns the parsed dictionary on success.
+    Returns an instance of that schema on success. Pass `model` to keep a call on the
+    model its prompt was written for.
     """
     if not client:
         logger.error("Gemini client is not available.")
         return None
     try:
-        # Define the generation configuration with the schema
-        generation_config = {
-            "response_mime_type": "application/json",
-            "response_schema": response_schema,
-        }
-        
-        response = client.models.generate_content(
-            model='gemini-1.5-flash',
-            config={
-                "response_mime_type": "application/json",
-                "response_schema": response_schema,
-												},
-            contents=prompt
-        )
+        with _inflight:
+            response = client.models.generate_content(
+                model=model,
+                config=_json_config(response_schema),
+                contents=prompt
+            )
         
         logger.info(f"Response: {response}")
         
@@ -79,14 +94,16 @@ def think_and_generate_json(prompt: str, response_schema: Type[T]) -> T | None:
                 logger.warning(f"Raw text from Gemini: {response.text}")
             return None
             
-        # Explicitly convert the google.protobuf.Struct object
-        # into a standard Python dictionary before unpacking it.
-        parsed_dict = dict(response.parsed)
-        
-        # Now, instantiate our Pydantic model with the clean dictionary.
-        validated_model_instance = response_schema(**parsed_dict)
-        
-        return validated_model_instance
+        parsed = response.parsed
+        if isinstance(parsed, response_schema):
+            # The SDK already validated the JSON into our model; don't do it twice.
+            # In DEV_MODE, re-check it anyway as a guard against SDK behaviour changes.
+            if Config.DEV_MODE:
+                response_schema.model_validate(parsed.model_dump())
+            return parsed
+
+        # Older SDK versions hand back a dict/Struct instead of the model instance.
+        return response_schema.model_validate(dict(parsed))
 
 
     except Exception as e:
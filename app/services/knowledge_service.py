@@ -2,6 +2,7 @@
 import logging
 import json
 from uuid import UUID
+from postgrest.types import ReturnMethod
 from ..db import supabase
 from ..utils.json_parser import safe_json_from_llm
 from . import openai_service, gemini_service
@@ -15,7 +16,7 @@ def ingest_text_knowledge(tenant_id: UUID, text_content: str, source_name: str)
     Takes a large block of text, uses an AI to create semantic chunks,
     generates embeddings for them, and stores them in the database.
     """
-    logger.info(f"KNOWLEDGE: Starting AI-powered ingestion for source '{source_name}'.")
+    logger.info("KNOWLEDGE: Starting AI-powered ingestion for source '%s'.", source_name)
 
     # 1. AI Semantic Chunking
     chunks = _get_ai_semantic_chunks(text_content)
@@ -23,7 +24,7 @@ def ingest_text_knowledge(tenant_id: UUID, text_content: str, source_name: str)
         logger.error("KNOWLEDGE: AI failed to generate any chunks. Aborting ingestion.")
         return 0
     
-    logger.info(f"KNOWLEDGE: AI generated {len(chunks)} semantic chunks.")
+    logger.info("KNOWLEDGE: AI generated %s semantic chunks.", len(chunks))
 
     # 2. Get batch embeddings
     logger.info("KNOWLEDGE: Generating batch embeddings for all chunks...")
@@ -44,11 +45,13 @@ def ingest_text_knowledge(tenant_id: UUID, text_content: str, source_name: str)
     ]
 
     try:
-        supabase.table('knowledge').insert(records_to_insert).execute()
-        logger.info(f"KNOWLEDGE: Successfully inserted {len(records_to_insert)} documents.")
+        # The payload is dominated by the embeddings; with the default return=representation
+        # PostgREST would send every row (embedding included) straight back to us.
+        supabase.table('knowledge').insert(records_to_insert, returning=ReturnMethod.minimal).execute()
+        logger.info("KNOWLEDGE: Successfully inserted %s documents.", len(records_to_insert))
         return len(records_to_insert)
     except Exception as e:
-        logger.error(f"KNOWLEDGE: Database insert failed. Error: {e}", exc_info=True)
+        logger.error("KNOWLEDGE: Database insert failed. Error: %s", e, exc_info=True)
         raise
 
 def _get_ai_semantic_chunks(raw_text: str) -> list[str]:
@@ -74,7 +77,7 @@ def _get_ai_semantic_chunks(raw_text: str) -> list[str]:
         
     parsed_json = safe_json_from_llm(response_str)
     if not parsed_json or 'knowledge_chunks' not in parsed_json:
-        logger.error(f"KNOWLEDGE: AI chunker failed to return valid JSON with 'knowledge_chunks' key. Raw response: {response_str}")
+        logger.error("KNOWLEDGE: AI chunker failed to return valid JSON with 'knowledge_chunks' key. Raw response: %s", response_str)
         return []
 
     return parsed_json['knowledge_chunks']
\ No newline at end of file
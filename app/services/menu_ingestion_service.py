@@ -1,5 +1,6 @@
 # app/services/menu_ingestion_service.py
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from uuid import UUID
 from typing import List # FIX #1: Import List for type hinting
 from pydantic import BaseModel # Import BaseModel for defining the schema
@@ -10,11 +11,26 @@ from ..db import supabase
 
 logger = logging.getLogger(__name__)
 
+# PostgreSQL bulk-insert throughput plateaus around this many rows per statement.
+MAX_INSERT_BATCH_SIZE = 1000
+
+# Describing products is all network wait on Gemini, so description prompts run side
+# by side. Bounded to stay well inside the API rate limits.
+MAX_CONCURRENT_PRODUCTS = 8
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PRODUCTS, thread_name_prefix="menu-ingestion")
+
+class MenuProductList(BaseModel):
+    """
+    The list structure we ask Gemini to fill when parsing a menu.
+    Defined at module scope so its schema is built once at import, not on every call.
+    """
+    products: List[ProductCreate]
+
 def ingest_menu_from_text(tenant_id: UUID, menu_text: str) -> dict:
     """
     Orchestrates the process of parsing menu text and creating products in batch.
     """
-    logger.info(f"MENU INGESTION: Starting for tenant {tenant_id}.")
+    logger.info("MENU INGESTION: Starting for tenant %s.", tenant_id)
     
     # Step 1: Use LLM to parse the unstructured text into structured data
     parsed_products = _parse_menu_with_ai(menu_text)
@@ -23,33 +39,72 @@ def ingest_menu_from_text(tenant_id: UUID, menu_text: str) -> dict:
     if not parsed_products:
         return {"message": "AI failed to identify any products in the provided text.", "total_identified": 0, "successfully_created": 0, "failed": 0}
 
-    logger.info(f"MENU INGESTION: AI identified {len(parsed_products)} potential products.")
+    logger.info("MENU INGESTION: AI identified %s potential products.", len(parsed_products))
     
     success_count = 0
     failure_count = 0
 
-    # Step 2: Iterate and create each product using our existing single-product workflow
-    for product_data in parsed_products:
+    # Step 2: AI Enrichment, one batched Gemini prompt per group of products (groups run concurrently)
+    # The data is already a validated Pydantic model from the parser
+    step = product_service.MAX_DESCRIPTIONS_PER_PROMPT
+    describe_futures = [
+        (group, _executor.submit(
+            product_service.generate_synthetic_descriptions_batch,
+            [(product_data.product_name, product_data.description) for product_data in group]
+        ))
+        for group in (parsed_products[start:start + step] for start in range(0, len(parsed_products), step))
+    ]
+    described = []
+    for group, future in describe_futures:
         try:
-            # The data is already a validated Pydantic model from the parser
-            _create_single_product(tenant_id, product_data)
-            success_count += 1
+            described.extend(zip(group, future.result()))
         except Exception as e:
-            logger.error(f"MENU INGESTION: Failed to create product '{product_data.product_name}'. Error: {e}")
+            logger.error("MENU INGESTION: Failed to describe a group of %s products. Error: %s", len(group), e)
+            failure_count += len(group)
+
+    # Step 3: Embed all synthetic descriptions in a single OpenAI call
+    try:
+        embeddings = openai_service.get_batch_embeddings([synthetic_desc for _, synthetic_desc in described])
+    except Exception as e:
+        logger.error("MENU INGESTION: Batch embedding failed for %s products. Error: %s", len(described), e)
+        failure_count += len(described)
+        described, embeddings = [], []
+
+    # Step 4: Tag every product in one batched pass, then build the rows (no DB writes yet)
+    try:
+        tag_ids_per_product = tagging_service.suggest_and_reconcile_tags_batch(
+            tenant_id,
+            [(product_data.product_name, synthetic_desc, product_embedding)
+             for (product_data, synthetic_desc), product_embedding in zip(described, embeddings)]
+        ) if described else []
+    except Exception as e:
+        logger.error("MENU INGESTION: Tagging failed for %s products. Error: %s", len(described), e)
+        failure_count += len(described)
+        described, embeddings, tag_ids_per_product = [], [], []
+    prepared = []
+    for (product_data, synthetic_desc), product_embedding, tag_ids in zip(described, embeddings, tag_ids_per_product):
+        if tag_ids is None:
             failure_count += 1
+            continue
+        prepared.append((product_service.build_product_row(tenant_id, product_data, synthetic_desc, product_embedding), tag_ids))
+
+    # Step 5: One transactional RPC for each batch of prepared products
+    for start in range(0, len(prepared), MAX_INSERT_BATCH_SIZE):
+        batch = prepared[start:start + MAX_INSERT_BATCH_SIZE]
+        try:
+            _insert_product_batch(batch)
+            success_count += len(batch)
+        except Exception as e:
+            logger.error("MENU INGESTION: Failed to insert a batch of %s products. Error: %s", len(batch), e)
+            failure_count += len(batch)
     
-    logger.info(f"MENU INGESTION: Process complete. Success: {success_count}, Failed: {failure_count}.")
+    logger.info("MENU INGESTION: Process complete. Success: %s, Failed: %s.", success_count, failure_count)
     return {"message": "Batch product ingestion complete.", "total_identified": len(parsed_products), "successfully_created": success_count, "failed": failure_count}
 
 
 def _parse_menu_with_ai(menu_text: str) -> List[ProductCreate] | None:
     """Uses Gemini to parse raw menu text into a list of ProductCreate objects."""
     
-    # Define the Pydantic model for the expected list structure INSIDE the function
-    # This keeps it scoped to where it's used.
-    class MenuProductList(BaseModel):
-        products: List[ProductCreate]
-
     prompt = f"""You are an expert menu data entry system. Your task is to read the following unstructured menu text and convert it into a structured list of products. Ignore all non-product text like headings, addresses, or opening hours. For each menu item, extract its name, a brief description if available, and its price.
 
     **Unstructured Menu Text:**
@@ -72,34 +127,29 @@ def _parse_menu_with_ai(menu_text: str) -> List[ProductCreate] | None:
     return parsed_model_instance.products
 
 
-def _create_single_product(tenant_id: UUID, product_data: ProductCreate):
+def _insert_product_batch(batch: List[tuple[dict, list[str]]]):
     """
-    This is our robust, single-product creation workflow, now as a helper function.
+    Inserts a batch of prepared products and all of their tag associations with one RPC,
+    so a batch is written atomically (no orphaned products if the association insert fails).
     """
-    logger.info(f"Creating product: {product_data.product_name}")
-    
-    # 1. AI Enrichment
-    synthetic_desc = product_service.generate_synthetic_description(product_data.product_name, product_data.description)
-    
-    # 2. Embedding
-    product_embedding = openai_service.get_embedding(synthetic_desc)
-    
-    # 3. Insert Product
-    product_dict = product_data.model_dump()
-    product_dict.update({
-        'tenant_id': str(tenant_id),
-        'description_embedding': product_embedding,
-        'generated_description': synthetic_desc
-    })
-    product_res = supabase.table('products').insert(product_dict).execute()
-    new_product_id = product_res.data[0]['id']
-    
-    # 4. Intelligent Tagging
-    final_tag_ids = tagging_service.suggest_and_reconcile_tags(
-        tenant_id, product_data.product_name, synthetic_desc, product_embedding
-    )
-    
-    # 5. Associate Tags
-    if final_tag_ids:
-        associations = [{"product_id": new_product_id, "tag_id": str(tag_id)} for tag_id in final_tag_ids]
-        supabase.table('product_tag_associations').insert(associations).execute()
\ No newline at end of file
+    # DB function that loops over the batch using the single-product function from
+    # the create-product endpoint, all inside one transaction. It returns only a count
+    # so the inserted rows (and their embeddings) aren't shipped back to us:
+    # CREATE FUNCTION create_products_with_tags(p_items jsonb)
+    # RETURNS integer AS $$
+    # DECLARE item jsonb; n integer := 0;
+    # BEGIN
+    #   FOR item IN SELECT * FROM jsonb_array_elements(p_items) LOOP
+    #     PERFORM create_product_with_tags(
+    #       item->'product',
+    #       ARRAY(SELECT jsonb_array_elements_text(item->'tag_ids'))::uuid[]);
+    #     n := n + 1;
+    #   END LOOP;
+    #   RETURN n;
+    # END; $$ LANGUAGE plpgsql;
+    res = supabase.rpc('create_products_with_tags', {
+        'p_items': [{'product': product_dict, 'tag_ids': tag_ids} for product_dict, tag_ids in batch]
+    }).execute()
+    if res.data != len(batch):
+        raise ValueError(f"DB Error: Bulk product insert created {res.data} of {len(batch)} products.")
+    logger.info("MENU INGESTION: Inserted %s products and %s tag associations.", len(batch), sum(len(tag_ids) for _, tag_ids in batch))
@@ -1,11 +1,28 @@
 # app/services/openai_service.py
 
 import logging
+import hashlib
+import threading
+from array import array
+from functools import lru_cache
+from cachetools import LRUCache
 from openai import OpenAI
 from ..config import Config
 
 logger = logging.getLogger(__name__)
 
+# The embeddings endpoint accepts at most this many inputs per request.
+MAX_EMBEDDING_BATCH_SIZE = 2048
+
+# sha256(model + normalized query) -> float32 embedding. Keyed by digest so long
+# messages don't pin their full text in memory.
+_query_embedding_cache: LRUCache = LRUCache(maxsize=8192)
+_query_embedding_cache_lock = threading.Lock()
+
+# Bounds in-flight embedding requests across threads; the client's own retries
+# (with backoff) then only have to absorb the occasional 429, not a burst.
+_inflight = threading.BoundedSemaphore(Config.OPENAI_MAX_CONCURRENCY)
+
 try:
     client = OpenAI(api_key=Config.OPENAI_API_KEY)
     logger.info("OpenAI client initialized successfully.")
@@ -21,23 +38,62 @@ def get_embedding(text: str, model="text-embedding-3-small") -> list[float]:
     try:
         # Replace newlines with spaces for better embedding performance
         text = text.replace("\n", " ")
-        response = client.embeddings.create(input=[text], model=model)
+        with _inflight:
+            response = client.embeddings.create(input=[text], model=model)
         return response.data[0].embedding
     except Exception as e:
         logger.error(f"OpenAI embedding failed for text: '{text[:50]}...'. Error: {e}")
         # Re-raise the exception to be handled by the calling endpoint
         raise e
 
+def get_cached_embedding(text: str, model="text-embedding-3-small") -> list[float]:
+    """
+    Same as get_embedding, but memoized in-process. Use it for short inputs that
+    repeat a lot (e.g. tag names like "vegan" or "spicy"), not for free text.
+    """
+    return _get_cached_embedding(text, model).tolist()
+
+@lru_cache(maxsize=4096)
+def _get_cached_embedding(text: str, model: str) -> array:
+    # Stored as a compact float32 array (~6KB per entry instead of ~50KB of Python floats).
+    # pgvector stores float4 anyway, so no precision is lost on the way to the DB.
+    return array('f', get_embedding(text, model))
+
+def get_query_embedding(text: str, model="text-embedding-3-small") -> list[float]:
+    """
+    Embedding for a user search query. The cache is keyed on the query with case and
+    whitespace normalized, so recurring messages ("hi", "Menu ", "what are your hours?")
+    hit it; the text sent to OpenAI is the query as written.
+    """
+    normalized = " ".join(text.lower().split())
+    key = hashlib.sha256(f"{model}\0{normalized}".encode()).digest()
+    with _query_embedding_cache_lock:
+        cached = _query_embedding_cache.get(key)
+    if cached is not None:
+        return cached.tolist()
+
+    embedding = array('f', get_embedding(text, model))
+    with _query_embedding_cache_lock:
+        _query_embedding_cache[key] = embedding
+    return embedding.tolist()
+
 def get_batch_embeddings(texts: list[str], model="text-embedding-3-small") -> list[list[float]]:
-    """Generates embeddings for a list of text strings in a single API call."""
+    """
+    Generates embeddings for a list of text strings in a single API call
+    (one call per MAX_EMBEDDING_BATCH_SIZE inputs for very large lists).
+    """
     if not client:
         raise ConnectionError("OpenAI client is not initialized.")
         
     try:
         # It's good practice to also clean up newlines here
         cleaned_texts = [text.replace("\n", " ") for text in texts]
-        response = client.embeddings.create(input=cleaned_texts, model=model)
-        return [emb.embedding for emb in response.data]
+        embeddings = []
+        for start in range(0, len(cleaned_texts), MAX_EMBEDDING_BATCH_SIZE):
+            with _inflight:
+                response = client.embeddings.create(input=cleaned_texts[start:start + MAX_EMBEDDING_BATCH_SIZE], model=model)
+            embeddings.extend(emb.embedding for emb in response.data)
+        return embeddings
     except Exception as e:
         logger.error(f"OpenAI batch embedding failed. Error: {e}")
         raise e
\ No newline at end of file
@@ -1,59 +1,147 @@
 # app/services/outbound_service.py
 
+import atexit
 import logging
+import random
+import threading
+import time
 import httpx
+import orjson
 from uuid import UUID
+from cachetools import TTLCache
 from ..config import Config
 from ..db import supabase
 
 logger = logging.getLogger(__name__)
 
+# One pooled client for every call to the Graph API, so consecutive messages reuse a
+# warm keep-alive connection instead of paying a fresh TCP + TLS handshake each time.
+_CLIENT = httpx.Client(
+    # An explicit transport so failed connection attempts are retried (with the pool's
+    # connections, not new clients). http2/limits have to be set here, not on the Client.
+    transport=httpx.HTTPTransport(
+        http2=True,
+        # Outbound traffic is bursty (a reply per inbound message), so let idle sockets live
+        # well past httpx's 5s default before they are dropped and must be re-handshaked.
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60),
+        retries=3,
+    ),
+    timeout=httpx.Timeout(10.0, connect=3.0),
+)
+atexit.register(_CLIENT.close)
+
+# Only statuses that mean Graph did not process the request are retried: a message POST
+# isn't idempotent, and after a 500/502/504 it may already have been sent. (Connection
+# failures are retried by the transport, before anything reaches Graph.)
+_RETRYABLE_STATUS_CODES = frozenset({429, 503})
+MAX_SEND_ATTEMPTS = 3
+MAX_RETRY_AFTER_SECONDS = 5.0
+
+# tenant_id -> WhatsApp credentials row, so a send doesn't cost a DB read every time.
+# A 401/403 from Graph evicts the entry (see _post_to_graph), which covers token rotation.
+_credentials_by_tenant: TTLCache = TTLCache(maxsize=1024, ttl=300)
+_credentials_cache_lock = threading.Lock()
+
+
+def _get_credentials(tenant_id: UUID) -> dict | None:
+    """Returns the tenant's phone number ID and access token, or None if either is missing."""
+    key = str(tenant_id)
+    with _credentials_cache_lock:
+        credentials = _credentials_by_tenant.get(key)
+    if credentials is not None:
+        return credentials
+
+    res = supabase.table('businesses').select('whatsapp_phone_number_id, whatsapp_access_token').eq('id', key).single().execute()
+    credentials = res.data
+    if not credentials or not credentials.get('whatsapp_access_token') or not credentials.get('whatsapp_phone_number_id'):
+        return None
+
+    with _credentials_cache_lock:
+        _credentials_by_tenant[key] = credentials
+    return credentials
+
+
+def _post_to_graph(tenant_id: UUID, credentials: dict, body: bytes) -> httpx.Response:
+    """
+    POSTs a JSON body to the tenant's Graph API messages endpoint. If the (possibly cached)
+    access token is rejected (401/403), re-reads the credentials from the DB and, if the
+    token has changed, retries once. 429/503 responses are retried with exponential
+    backoff, honouring Retry-After; a Retry-After longer than MAX_RETRY_AFTER_SECONDS
+    returns the response instead of retrying early.
+    """
+    def post(creds: dict) -> httpx.Response:
+        headers = {"Authorization": f"Bearer {creds['whatsapp_access_token']}", "Content-Type": "application/json"}
+        url = f"https://graph.facebook.com/v22.0/{creds['whatsapp_phone_number_id']}/messages"
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            response = _CLIENT.post(url, headers=headers, content=body)
+            if response.status_code not in _RETRYABLE_STATUS_CODES or attempt == MAX_SEND_ATTEMPTS - 1:
+                return response
+            delay = _retry_delay(response, attempt)
+            if delay is None:
+                return response
+            logger.warning("OUTBOUND: Graph returned %s for tenant %s. Retrying in %.2fs.", response.status_code, tenant_id, delay)
+            time.sleep(delay)
+        return response
+
+    response = post(credentials)
+    if response.status_code in (401, 403):
+        with _credentials_cache_lock:
+            _credentials_by_tenant.pop(str(tenant_id), None)
+        fresh_credentials = _get_credentials(tenant_id)
+        if fresh_credentials and fresh_credentials['whatsapp_access_token'] != credentials['whatsapp_access_token']:
+            logger.info("OUTBOUND: Access token for tenant %s was rotated. Retrying with the new one.", tenant_id)
+            response = post(fresh_credentials)
+    return response
+
+def _retry_delay(response: httpx.Response, attempt: int) -> float | None:
+    """
+    Seconds to wait before the next attempt: Retry-After if Graph sent one, else backoff
+    with jitter. None if Graph asked for a longer wait than we are willing to block for.
+    """
+    retry_after = response.headers.get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        delay = float(retry_after)
+        return delay if delay <= MAX_RETRY_AFTER_SECONDS else None
+    return 0.2 * 2 ** attempt + random.uniform(0, 0.1)
+
 def send_whatsapp_message(tenant_id: UUID, message_payload: dict):
     """
     Sends a pre-formatted payload to the WhatsApp API for a specific tenant.
     This service is "dumb" - it only handles delivery, not content creation.
     """
     to_number = message_payload.get("to")
-    logger.info(f"OUTBOUND: Preparing to deliver payload for tenant {tenant_id} to {to_number}.")
+    logger.info("OUTBOUND: Preparing to deliver payload for tenant %s to %s.", tenant_id, to_number)
 
-    # Step 1: Fetch credentials
+    # Step 1: Fetch credentials (cached per tenant)
     try:
-        res = supabase.table('businesses').select('whatsapp_phone_number_id, whatsapp_access_token').eq('id', tenant_id).single().execute()
-        credentials = res.data
-        if not credentials or not credentials.get('whatsapp_access_token') or not credentials.get('whatsapp_phone_number_id'):
-            logger.error(f"OUTBOUND: Failed. Missing credentials for tenant {tenant_id}.")
-            return
+        credentials = _get_credentials(tenant_id)
     except Exception as e:
-        logger.error(f"OUTBOUND: Failed to fetch credentials for tenant {tenant_id}. Error: {e}")
+        logger.error("OUTBOUND: Failed to fetch credentials for tenant %s. Error: %s", tenant_id, e)
+        return
+    if not credentials:
+        logger.error("OUTBOUND: Failed. Missing credentials for tenant %s.", tenant_id)
         return
 
     # DEV MODE check
     if Config.DEV_MODE:
         logger.info("--- DEV MODE: SIMULATED WHATSAPP PAYLOAD SEND ---")
-        logger.info(f"  tenant ID: {tenant_id}")
-        logger.info(f"   Phone ID: {credentials['whatsapp_phone_number_id']}")
-        logger.info(f"      PAYLOAD: {message_payload}")
+        logger.info("  tenant ID: %s", tenant_id)
+        logger.info("   Phone ID: %s", credentials['whatsapp_phone_number_id'])
+        logger.info("      PAYLOAD: %s", message_payload)
         logger.info("---------------------------------------------")
         return
 
     # Production Logic
-    phone_number_id = credentials['whatsapp_phone_number_id']
-    access_token = credentials['whatsapp_access_token']
-    
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    url = f"https://graph.facebook.com/v22.0/{phone_number_id}/messages"
-    
-    logger.info(f"OUTBOUND: Delivering production payload to {to_number}...")
+    logger.info("OUTBOUND: Delivering production payload to %s...", to_number)
     try:
-        with httpx.Client() as client:
-            # THE FIX: We now send the `message_payload` directly as the JSON body.
-            response = client.post(url, headers=headers, json=message_payload)
-            response.raise_for_status()
-        logger.info(f"OUTBOUND: Payload delivered successfully for tenant {tenant_id}.")
+        # THE FIX: We now send the `message_payload` directly as the JSON body.
+        response = _post_to_graph(tenant_id, credentials, orjson.dumps(message_payload))
+        response.raise_for_status()
+        logger.info("OUTBOUND: Payload delivered successfully for tenant %s.", tenant_id)
     except httpx.HTTPStatusError as e:
-        logger.error(f"OUTBOUND: HTTP Error delivering payload for tenant {tenant_id}: {e.response.status_code} - {e.response.text}")
+        logger.error("OUTBOUND: HTTP Error delivering payload for tenant %s: %s - %s", tenant_id, e.response.status_code, e.response.text)
     except Exception as e:
-        logger.error(f"OUTBOUND: Unexpected error delivering payload for tenant {tenant_id}: {e}", exc_info=True)
+        logger.error("OUTBOUND: Unexpected error delivering payload for tenant %s: %s", tenant_id, e, exc_info=True)
         
 
 # In app/services/outbound_service.py
@@ -65,31 +153,27 @@ def send_read_receipt_and_typing(tenant_id: UUID, message_id: str):
     Marks a message as read and displays a typing indicator to the user.
     This should be called immediately upon receiving a message.
     """
-    logger.info(f"OUTBOUND: Sending Read Receipt/Typing Indicator for message {message_id}")
+    logger.info("OUTBOUND: Sending Read Receipt/Typing Indicator for message %s", message_id)
 
-    # Step 1: Fetch credentials (this logic is the same)
+    # Step 1: Fetch credentials (cached per tenant, same as above)
     try:
-        res = supabase.table('businesses').select('whatsapp_phone_number_id, whatsapp_access_token').eq('id', tenant_id).single().execute()
-        credentials = res.data
-        if not credentials or not credentials.get('whatsapp_access_token') or not credentials.get('whatsapp_phone_number_id'):
-            logger.error(f"OUTBOUND: Failed. Missing credentials for tenant {tenant_id}.")
-            return
+        credentials = _get_credentials(tenant_id)
     except Exception as e:
-        logger.error(f"OUTBOUND: Failed to fetch credentials for tenant {tenant_id}. Error: {e}")
+        logger.error("OUTBOUND: Failed to fetch credentials for tenant %s. Error: %s", tenant_id, e)
+        return
+    if not credentials:
+        logger.error("OUTBOUND: Failed. Missing credentials for tenant %s.", tenant_id)
         return
 
     # DEV MODE check
     if Config.DEV_MODE:
         logger.info("--- DEV MODE: SIMULATED READ RECEIPT & TYPING INDICATOR ---")
-        logger.info(f"  tenant ID: {tenant_id}")
-        logger.info(f"   Message ID: {message_id}")
+        logger.info("  tenant ID: %s", tenant_id)
+        logger.info("   Message ID: %s", message_id)
         logger.info("---------------------------------------------------------")
         return
 
     # Production Logic
-    phone_number_id = credentials['whatsapp_phone_number_id']
-    access_token = credentials['whatsapp_access_token']
-	
     json_payload = {
         "messaging_product": "whatsapp",
         "status": "read",
@@ -99,16 +183,12 @@ def send_read_receipt_and_typing(tenant_id: UUID, message_id: str):
 								}
     }
     
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    url = f"https://graph.facebook.com/v22.0/{phone_number_id}/messages"
-    
-    logger.info(f"OUTBOUND: Sending 'read' status for message {message_id}...")
+    logger.info("OUTBOUND: Sending 'read' status for message %s...", message_id)
     try:
-        with httpx.Client() as client:
-            response = client.post(url, headers=headers, json=json_payload)
-            response.raise_for_status()
-        logger.info(f"OUTBOUND: 'Read' status sent successfully for message {message_id}.")
+        response = _post_to_graph(tenant_id, credentials, orjson.dumps(json_payload))
+        response.raise_for_status()
+        logger.info("OUTBOUND: 'Read' status sent successfully for message %s.", message_id)
     except httpx.HTTPStatusError as e:
-        logger.error(f"OUTBOUND: HTTP Error sending read receipt: {e.response.status_code} - {e.response.text}")
+        logger.error("OUTBOUND: HTTP Error sending read receipt: %s - %s", e.response.status_code, e.response.text)
     except Exception as e:
-        logger.error(f"OUTBOUND: Unexpected error sending read receipt: {e}", exc_info=True)
\ No newline at end of file
+        logger.error("OUTBOUND: Unexpected error sending read receipt: %s", e, exc_info=True)
\ No newline at end of file
@@ -1,12 +1,73 @@
 # app/services/product_service.py
 import logging
+import re
+import threading
+from uuid import UUID
+from typing import List
+from cachetools import LRUCache
+from pydantic import BaseModel
+from ..api.schemas import ProductCreate
 from . import gemini_service
 
 logger = logging.getLogger(__name__)
 
+# Keeps each batched prompt (and the JSON Gemini returns for it) comfortably sized.
+MAX_DESCRIPTIONS_PER_PROMPT = 25
+
+# A user description is rich enough to embed as-is when it is at least this long and names
+# at least RICH_DESCRIPTION_ATTRIBUTES distinct attributes (ingredients, materials, sizes,
+# dietary and preparation terms) that recommendations can match on. Length alone lets a
+# long but vague blurb ("you will love this, perfect for any occasion...") skip enrichment.
+RICH_DESCRIPTION_WORDS = 40
+RICH_DESCRIPTION_ATTRIBUTES = 3
+_ATTRIBUTE_WORDS = frozenset({
+    # flavour and ingredients
+    "chocolate", "vanilla", "caramel", "strawberry", "lemon", "coffee", "cheese", "cream",
+    "butter", "garlic", "chili", "pepper", "honey", "nuts", "almond", "peanut", "coconut",
+    "chicken", "beef", "pork", "lamb", "fish", "shrimp", "egg", "rice", "beans", "tomato",
+    "onion", "mushroom", "avocado", "fruit", "herbs", "spices", "sauce", "dough", "sugar",
+    "spicy", "sweet", "savory", "sour", "salty", "smoky", "creamy", "crispy", "crunchy",
+    # preparation
+    "grilled", "fried", "baked", "roasted", "steamed", "smoked", "fresh", "frozen", "homemade",
+    # dietary
+    "vegan", "vegetarian", "gluten", "dairy", "lactose", "halal", "kosher", "organic", "keto",
+    "sugar-free", "gluten-free", "dairy-free",
+    # materials and build
+    "cotton", "leather", "wool", "silk", "linen", "denim", "polyester", "steel", "aluminium",
+    "aluminum", "wood", "wooden", "glass", "ceramic", "plastic", "rubber", "waterproof",
+    # size and quantity
+    "small", "medium", "large", "ml", "litre", "liter", "kg", "grams", "oz", "inch",
+    "cm", "serves", "pieces", "pack", "size", "weight",
+})
+_ATTRIBUTE_TOKEN_RE = re.compile(r"[a-z]+(?:-[a-z]+)*")
+
+# (product_name, user_description) -> generated description, so re-ingesting the same
+# menu or product doesn't pay for the same copy again. Gemini failures are not cached.
+_description_cache: LRUCache = LRUCache(maxsize=4096)
+_description_cache_lock = threading.Lock()
+
+class DescList(BaseModel):
+    """Schema for the batched description prompt: one entry per numbered product, in order."""
+    descriptions: List[str]
+
+def build_product_row(tenant_id: UUID, product_data: ProductCreate, synthetic_desc: str, product_embedding: list[float]) -> dict:
+    """Builds the `products` row for a described, embedded product (single and batch create)."""
+    # dict() copies the field values without a serializer pass, and picks up any field
+    # added to ProductCreate later. generated_description needs:
+    # ALTER TABLE products ADD COLUMN generated_description TEXT;
+    return {
+        **dict(product_data),
+        'tenant_id': str(tenant_id),
+        'description_embedding': product_embedding,
+        'generated_description': synthetic_desc
+    }
+
 def generate_synthetic_description(product_name: str, user_description: str | None) -> str:
     """Generates a rich, synthetic description for a product."""
-    
+    known = _known_description(product_name, user_description)
+    if known is not None:
+        return known
+
     prompt = f"""You are a creative copywriter for a retail store. 
     Given the following product information, write a rich, one-paragraph descriptive text that would be useful for a recommendation system.
     Include key attributes, potential use cases, and associated concepts. Do not use markdown.
@@ -25,4 +86,74 @@ def generate_synthetic_description(product_name: str, user_description: str | No
         return f"{product_name}. {user_description or ''}".strip()
         
     logger.info(f"Generated synthetic description for '{product_name}'")
-    return synthetic_description.strip()
\ No newline at end of file
+    return _remember_description(product_name, user_description, synthetic_description.strip())
+
+
+def _known_description(product_name: str, user_description: str | None) -> str | None:
+    """Returns a description that needs no LLM call (already rich, or generated before), else None."""
+    if user_description and _is_rich_description(user_description):
+        return user_description.strip()
+    with _description_cache_lock:
+        return _description_cache.get((product_name, user_description))
+
+
+def _is_rich_description(description: str) -> bool:
+    if len(description.split()) < RICH_DESCRIPTION_WORDS:
+        return False
+    attributes = _ATTRIBUTE_WORDS.intersection(_ATTRIBUTE_TOKEN_RE.findall(description.lower()))
+    return len(attributes) >= RICH_DESCRIPTION_ATTRIBUTES
+
+
+def _remember_description(product_name: str, user_description: str | None, description: str) -> str:
+    with _description_cache_lock:
+        _description_cache[(product_name, user_description)] = description
+    return description
+
+
+def generate_synthetic_descriptions_batch(products: list[tuple[str, str | None]]) -> list[str]:
+    """
+    Generates synthetic descriptions for several (product_name, user_description) pairs
+    with a single Gemini call. Returns one description per product, in input order.
+    Products that need no LLM call (see _known_description) are left out of the prompt.
+    """
+    descriptions = [_known_description(product_name, user_description) for product_name, user_description in products]
+    pending = [i for i, description in enumerate(descriptions) if description is None]
+    if pending:
+        generated = _generate_descriptions_with_llm([products[i] for i in pending])
+        for i, description in zip(pending, generated):
+            descriptions[i] = description
+    return descriptions
+
+
+def _generate_descriptions_with_llm(products: list[tuple[str, str | None]]) -> list[str]:
+    """The batched Gemini prompt behind generate_synthetic_descriptions_batch."""
+    numbered_products = "\n".join(
+        f"{i}. Product Name: '{product_name}' | User's Provided Description: '{user_description or 'None provided'}'"
+        for i, (product_name, user_description) in enumerate(products, start=1)
+    )
+    prompt = f"""You are a creative copywriter for a retail store. 
+    For EACH of the numbered products below, write a rich, one-paragraph descriptive text that would be useful for a recommendation system.
+    Include key attributes, potential use cases, and associated concepts. Do not use markdown.
+
+    **Products:**
+    {numbered_products}
+
+    **Your Task:**
+    Return exactly {len(products)} descriptions in the `descriptions` list, in the same order as the numbered products above.
+    """
+
+    # The descriptions are matched back to products by position, so a list of the
+    # wrong length is unusable. Ask once more, then fall back to one call per product.
+    for _ in range(2):
+        # Same model as the single-product path (generate_text)
+        result = gemini_service.think_and_generate_json(prompt, DescList, model="gemini-2.5-flash")
+        if result and len(result.descriptions) == len(products):
+            return [
+                _remember_description(product_name, user_description, description.strip())
+                if description.strip() else f"{product_name}. {user_description or ''}".strip()
+                for description, (product_name, user_description) in zip(result.descriptions, products)
+            ]
+        logger.warning(f"Batched description prompt returned {len(result.descriptions) if result else 'no'} descriptions for {len(products)} products.")
+
+    logger.warning("Falling back to generating synthetic descriptions one product at a time.")
+    return [generate_synthetic_description(product_name, user_description) for product_name, user_description in products]
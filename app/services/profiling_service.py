@@ -1,12 +1,26 @@
 # app/services/profiling_service.py
 import logging
 import json
+import threading
 from uuid import UUID
+from typing import List
+from cachetools import TTLCache
+from pydantic import BaseModel
 from ..db import supabase
 from . import gemini_service
 
 logger = logging.getLogger(__name__)
 
+# tenant_id -> JSON list of the tenant's tag names, already dumped for the prompt.
+# Tags change rarely, and the API process that creates them can't reach this cache,
+# so a new tag shows up here once the entry expires (at most 10 minutes).
+_tags_context_by_tenant: TTLCache = TTLCache(maxsize=2048, ttl=600)
+_tags_cache_lock = threading.Lock()
+
+class InferredTags(BaseModel):
+    """Schema Gemini fills when inferring a user's interests from a message."""
+    inferred_tags: List[str]
+
 def run_profiling_from_event(event_payload: dict):
     """The main entrypoint for the profiling service, triggered by a worker."""
     logger.info("--- Starting Profile Analysis Workflow ---")
@@ -21,20 +35,17 @@ def run_profiling_from_event(event_payload: dict):
     except (KeyError, IndexError) as e:
         raise ValueError(f"Could not parse required fields from event payload. Error: {e}")
 
-    # 2. Identify tenant & User
+    # 2. Identify tenant
     tenant = _get_tenant(tenant_phone_id)
     if not tenant: raise ValueError(f"No tenant found with phone_number_id {tenant_phone_id}")
-    
-    user = _find_or_create_user(tenant['id'], user_phone, user_name)
 
     # 3. Use Gemini to infer tags
     inferred_tags = _get_inferred_tags(tenant['id'], user_message)
     if not inferred_tags:
-        logger.info("No tags inferred. Ending profiling workflow.")
-        return
+        logger.info("No tags inferred. Recording the user only.")
 
-    # 4. Update the user's profile graph
-    _update_user_interest_scores(user['id'], inferred_tags)
+    # 4. Upsert the user and update their profile graph
+    _record_profile_event(tenant['id'], user_phone, user_name, inferred_tags)
     logger.info("--- Profile Analysis Workflow COMPLETED ---")
 
 def _get_tenant(phone_number_id: str) -> dict | None:
@@ -42,45 +53,56 @@ def _get_tenant(phone_number_id: str) -> dict | None:
     res = supabase.table('businesses').select('id').eq('whatsapp_phone_number_id', phone_number_id).single().execute()
     return res.data
 
-def _find_or_create_user(tenant_id: UUID, phone_number: str, name: str) -> dict:
-    logger.info(f"PROFILING: Finding or creating user for phone {phone_number}")
-    res = supabase.table('users').select('*').eq('tenant_id', tenant_id).eq('phone_number', phone_number).maybe_single().execute()
-    
-    if res and res.data:
-        logger.info(f"PROFILING: Found existing user {res.data['id']}")
-        return res.data
-    else:
-        logger.info("PROFILING: New user detected. Creating record.")
-        new_user_res = supabase.table('users').insert({
-            "tenant_id": str(tenant_id), "phone_number": phone_number, "user_name": name
-        }).execute()
-        return new_user_res.data[0]
+def _get_tags_context(tenant_id: UUID) -> str:
+    key = str(tenant_id)
+    with _tags_cache_lock:
+        tags_context = _tags_context_by_tenant.get(key)
+    if tags_context is not None:
+        return tags_context
+
+    tags_res = supabase.table('product_tags').select('tag_name').eq('tenant_id', key).execute()
+    tags_context = json.dumps([t['tag_name'] for t in tags_res.data])
+    with _tags_cache_lock:
+        _tags_context_by_tenant[key] = tags_context
+    return tags_context
 
 def _get_inferred_tags(tenant_id: UUID, message: str) -> list[str]:
     logger.info("PROFILING: Inferring tags with Gemini...")
-    tags_res = supabase.table('product_tags').select('tag_name').eq('tenant_id', tenant_id).execute()
-    tags_context = json.dumps([t['tag_name'] for t in tags_res.data])
+    tags_context = _get_tags_context(tenant_id)
 
     prompt = f"""You are a user analyst...
     **Available Tags:** {tags_context}
     **User's Message:** "{message}"
     ... (rest of prompt as designed) ...
     """
-    response_str = gemini_service.generate_text(prompt) # Use fast model
-    if not response_str: return []
-    try:
-        data = json.loads(response_str.strip().replace("`", ""))
-        inferred = data.get('inferred_tags', [])
-        logger.info(f"PROFILING: Gemini inferred tags: {inferred}")
-        return inferred
-    except json.JSONDecodeError:
-        return []
+    # Schema-constrained output: no markdown fences to strip, no JSON to hand-parse
+    # Stays on the model the free-text version of this call used
+    result = gemini_service.think_and_generate_json(prompt, InferredTags, model="gemini-2.5-flash")
+    if not result: return []
+    logger.info(f"PROFILING: Gemini inferred tags: {result.inferred_tags}")
+    return result.inferred_tags
 
-def _update_user_interest_scores(user_id: UUID, tag_names: list[str]):
-    logger.info(f"PROFILING: Updating interest scores for user {user_id} with tags: {tag_names}")
-    
-    # Use the robust DB function to handle the upsert logic
-    supabase.rpc('increment_interest_scores', {
-        'p_user_id': str(user_id), 'p_tag_names': tag_names
+def _record_profile_event(tenant_id: UUID, phone_number: str, name: str, tag_names: list[str]):
+    logger.info(f"PROFILING: Recording profile event for phone {phone_number} with tags: {tag_names}")
+    # Upserting the user and bumping their scores in one round-trip. The no-op DO UPDATE
+    # makes RETURNING yield the existing row too, so concurrent events for a brand-new
+    # user cannot race:
+    # CREATE FUNCTION profile_event(p_tenant_id uuid, p_user_phone text, p_user_name text, p_tags text[])
+    # RETURNS uuid AS $$
+    # DECLARE v_user_id uuid;
+    # BEGIN
+    #   INSERT INTO users (tenant_id, phone_number, user_name)
+    #   VALUES (p_tenant_id, p_user_phone, p_user_name)
+    #   ON CONFLICT (tenant_id, phone_number) DO UPDATE SET phone_number = EXCLUDED.phone_number
+    #   RETURNING id INTO v_user_id;
+    #   IF cardinality(p_tags) > 0 THEN
+    #     PERFORM increment_interest_scores(v_user_id, p_tags);
+    #   END IF;
+    #   RETURN v_user_id;
+    # END;
+    # $$ LANGUAGE plpgsql;
+    supabase.rpc('profile_event', {
+        'p_tenant_id': str(tenant_id), 'p_user_phone': phone_number,
+        'p_user_name': name, 'p_tags': tag_names
     }).execute()
-    logger.info("PROFILING: Successfully called DB function to update scores.")
\ No newline at end of file
+    logger.info("PROFILING: Successfully called DB function to record the event.")
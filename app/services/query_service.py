@@ -1,28 +1,29 @@
 # app/services/query_service.py
 import logging
 import json
+import threading
+from uuid import UUID
+from concurrent.futures import Future
 from typing import List, Dict
+from cachetools import TTLCache
+from ..config import Config
 from . import gemini_service
 
 logger = logging.getLogger(__name__)
 
-def refine_user_query(
-				raw_user_message: str, 
-				tenant_name: str,
-				tenant_bio: str,
-				conversation_history: List[Dict],
-				tenant_prompt
-) -> str:
-				"""
-				Uses a fast LLM with context to refine a user message into an optimal search query.
-				"""
-				logger.info(f"Query Refinement: Starting for raw message: '{raw_user_message}'")
+# (tenant_id, message, last history turn) -> refined query. Absorbs Meta's duplicate webhook
+# deliveries, which would otherwise each pay for the same Gemini call.
+_refined_query_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+# Same key -> Future of the refinement currently running for it, so concurrent duplicates
+# wait for that one call instead of starting their own.
+_inflight_refinements: dict[tuple, Future] = {}
+_refine_lock = threading.Lock()
 
-				try:
-					if not raw_user_message or not raw_user_message.strip():
-						return ""
+# Opening messages shorter than this many words skip the LLM (see refine_user_query).
+SHORT_MESSAGE_WORDS = 4
 
-					prompt = f"""
+# The static body of the refinement prompt, filled in with str.format per call.
+_REFINE_PROMPT_TEMPLATE = """
 					Your a search intent analysis engine. Your task is to look at a chat understand what the user wants and create a detailed descriptive text of the users search intent for rag search on knowledge base to find the knowledge needed to help the user.
 					Your job is vital because we need to match the right knowledge from our knowledge base when we do a vector search with the embedding of the descriptive text you provide.
 
@@ -32,10 +33,10 @@ def refine_user_query(
 					- tenant Prompt: This will help you understand the task of the response AI because you are gettign information for them: {tenant_prompt}
 
 					**RECENT CONVERSATION:**
-					{json.dumps(conversation_history)}
+					{history}
 
 					**USER'S LATEST MESSAGE:**
-					"{raw_user_message}"
+					"{message}"
 
 			**INSTRUCTIONS:**
 					1.  **Identify the Core Intent:** What is the user's fundamental need? (e.g., "hungry for a cheap lunch").
@@ -45,14 +46,89 @@ def refine_user_query(
 
 					**Your Descriptive Text:**
 					"""
+
+def refine_user_query(
+				tenant_id: UUID,
+				raw_user_message: str, 
+				tenant_name: str,
+				tenant_bio: str,
+				conversation_history: List[Dict],
+				tenant_prompt
+) -> str:
+				"""
+				Uses a fast LLM with context to refine a user message into an optimal search query.
+				Identical requests within a short window share one LLM call.
+				"""
+				if not raw_user_message or not raw_user_message.strip():
+					return ""
+
+				# An opening "hi" / "menu please" has no context to expand on; the raw text is as good
+				# a search query as the LLM would produce. Follow-ups ("yes, that one") still go to the
+				# LLM, since it's the history that gives them meaning.
+				if not conversation_history and len(raw_user_message.split()) < SHORT_MESSAGE_WORDS:
+					logger.info("Query Refinement: Short opening message, using it as the query directly.")
+					return raw_user_message
+
+				last_turn = json.dumps(conversation_history[-1], sort_keys=True) if conversation_history else None
+				key = (str(tenant_id), raw_user_message, last_turn)
+				with _refine_lock:
+					cached = _refined_query_cache.get(key)
+					if cached is not None:
+						logger.info("Query Refinement: Reusing recent refinement for an identical message.")
+						return cached
+					inflight = _inflight_refinements.get(key)
+					is_leader = inflight is None
+					if is_leader:
+						inflight = _inflight_refinements[key] = Future()
+
+				if not is_leader:
+					return inflight.result()
+
+				refined_query, refined = raw_user_message, False
+				try:
+					refined_query, refined = _generate_refined_query(raw_user_message, tenant_name, tenant_bio, conversation_history, tenant_prompt)
+				finally:
+					with _refine_lock:
+						_inflight_refinements.pop(key, None)
+						# Fallbacks to the raw message aren't cached, so the next delivery retries the LLM
+						if refined:
+							_refined_query_cache[key] = refined_query
+					inflight.set_result(refined_query)
+				return refined_query
+
+def _generate_refined_query(
+				raw_user_message: str, 
+				tenant_name: str,
+				tenant_bio: str,
+				conversation_history: List[Dict],
+				tenant_prompt
+) -> tuple[str, bool]:
+				"""
+				The uncached Gemini call behind refine_user_query. Returns (query, refined); refined
+				is False when the query is the raw message as a fallback.
+				"""
+				logger.info(f"Query Refinement: Starting for raw message: '{raw_user_message}'")
+
+				try:
+					if not raw_user_message or not raw_user_message.strip():
+						return "", False
+
+					prompt = _REFINE_PROMPT_TEMPLATE.format(
+						tenant_name=tenant_name,
+						tenant_bio=tenant_bio,
+						tenant_prompt=tenant_prompt,
+						# Only the latest turns matter for intent; older ones just add prompt tokens
+						history=json.dumps(conversation_history[-Config.REFINE_HISTORY_TURNS:] if Config.REFINE_HISTORY_TURNS > 0 else []),
+						message=raw_user_message,
+					)
 					# Use the fast, non-thinking text generation.
 					refined_query = gemini_service.generate_text(prompt)
 					if not refined_query or not refined_query.strip():
 						logger.warning("Query Refinement: LLM returned an empty query. Falling back to original message.")
-						return raw_user_message
+						return raw_user_message, False
 					logger.info(f"Query Refinement: Refined query is: '{refined_query.strip()}'")
-					return refined_query.strip()
+					return refined_query.strip(), True
 
 				except Exception as e:
 					logger.info(f"Query Service failed: {e}")
-					return raw_user_message
\ No newline at end of file
+					return raw_user_message, False
\ No newline at end of file
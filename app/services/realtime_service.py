@@ -1,13 +1,18 @@
 # app/services/realtime_service.py
 import logging
-import json
+import orjson
+import hashlib
+import re
+import threading
 from uuid import UUID
+from functools import lru_cache
 from typing import Optional, Dict, Any, List
 
 # Import Pydantic for internal data validation
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
+from cachetools import TTLCache
 
-from ..api.schemas import ActionPlan
+from ..api.schemas import ActionPlan, WhatsAppInbound
 
 from ..db import supabase
 from ..config import Config
@@ -17,6 +22,33 @@ from ..utils.json_parser import safe_json_from_llm
 
 logger = logging.getLogger(__name__)
 
+# How much per-user context begin_realtime_task returns with the user.
+HISTORY_TURNS = 20
+MEMORY_FACTS = 10
+
+# What of that context makes it into the action-plan prompt: the newest turns that fit in
+# the character budget, and the memory facts that overlap most with the message.
+PROMPT_HISTORY_CHARS = 3000
+PROMPT_MEMORY_FACTS = 5
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+# phone_number_id -> tenantContext. Every inbound message needs it and it rarely changes,
+# so entries live for an hour (persona edits included); warm_tenant_cache() preloads it
+# at worker start, sized to hold every tenant.
+_tenant_by_phone_id: TTLCache = TTLCache(maxsize=4096, ttl=3600)
+_tenant_cache_lock = threading.Lock()
+
+# sha256(prompt) -> ActionPlan. Only reached when the whole prompt repeats, which in
+# practice means a first message with no history or memory ("hi", "what are your hours?")
+# against unchanged knowledge. Plans that trigger tools are never stored.
+_action_plan_cache: TTLCache = TTLCache(maxsize=2048, ttl=600)
+_action_plan_cache_lock = threading.Lock()
+
+# (tenant_id, blake2b(refined query)) -> RAG chunks. Skips the embedding and match_knowledge
+# calls for repeated questions; knowledge edits show up once the entry expires.
+_rag_cache: TTLCache = TTLCache(maxsize=4096, ttl=300)
+_rag_cache_lock = threading.Lock()
+
 # This will eventually come from a config or DB
 CAPABILITY_PROMP = """
 - You *can* help users based on the tenant's knowledge base (hours, locations).
@@ -190,8 +222,65 @@ class LLMContext(BaseModel):
     long_term_memory: List[Dict[str, str]] = []
     rag_knowledge: List[str] = []
 
+def _dumps(obj) -> str:
+    # orjson is several times faster than json.dumps on these lists of dicts, and its
+    # compact output (no separator spaces, raw UTF-8) spends fewer prompt tokens.
+    return orjson.dumps(obj).decode()
+
+def _compact_history(history: List[Dict[str, str]], max_chars: int = PROMPT_HISTORY_CHARS) -> List[Dict[str, str]]:
+    """The most recent turns whose combined content fits in max_chars (always at least the last one)."""
+    kept, used = 0, 0
+    for turn in reversed(history):
+        used += len(turn.get('content') or '')
+        if kept and used > max_chars:
+            break
+        kept += 1
+    return history[len(history) - kept:]
+
+def _select_memory(memory: List[Dict[str, str]], message: str | None, limit: int = PROMPT_MEMORY_FACTS) -> List[Dict[str, str]]:
+    """The facts sharing the most words with the message; ties keep their stored order."""
+    if len(memory) <= limit:
+        return memory
+    words = set(_WORD_RE.findall((message or '').lower()))
+    def overlap(fact: Dict[str, str]) -> int:
+        fact_text = f"{fact.get('fact_key', '')} {fact.get('fact_value', '')}".lower().replace('_', ' ')
+        return len(words.intersection(_WORD_RE.findall(fact_text)))
+    return sorted(memory, key=overlap, reverse=True)[:limit]
+
+@lru_cache(maxsize=512)
+def _build_static_prefix(tenant_id: UUID, tenant_name: str, persona: str) -> str:
+    # Keyed on the name and persona too, so an edited tenant gets a fresh prefix
+    # as soon as the tenant cache refreshes.
+    # Level 1 is our SYSTEM_CORE_PROMPT; level 2 is the tenant-specific persona from the DB.
+    return f"""
+        **Your Identity:** Your name is Astro. You are an user assistant representing {	tenant_name	}.
+
+        {SYSTEM_CORE_PROMPT}
+
+        ---
+        **tenant-SPECIFIC STYLE GUIDELINES (Adopt this tone):**
+        {persona}
+        ---
+"""
+
 # --- The Service Class ---
 
+def warm_tenant_cache():
+    """Loads every tenant with a WhatsApp number into the tenant cache in one query."""
+    res = supabase.table('businesses').select('id, system_prompt, tenant_name, bio, whatsapp_phone_number_id').execute()
+    tenants = {}
+    for row in res.data or []:
+        phone_number_id = row.pop('whatsapp_phone_number_id', None)
+        if not phone_number_id:
+            continue
+        try:
+            tenants[phone_number_id] = tenantContext(**row)
+        except ValidationError:
+            continue # Incomplete profile: _get_tenant fails it on its own if it ever messages
+    with _tenant_cache_lock:
+        _tenant_by_phone_id.update(tenants)
+    logger.info("REALTIME: Warmed tenant cache with %s tenants.", len(tenants))
+
 class RealtimeService:
     """
     A robust, fail-fast service to handle a single real-time task from the queue.
@@ -209,6 +298,7 @@ class RealtimeService:
         # These will be populated by the workflow methods.
         # They are 'Optional' because they don't exist until the methods run.
         self.user_phone: Optional[str] = None
+        self.user_name: Optional[str] = None
         self.user_message: Optional[str] = None
         self.tenant: Optional[tenantContext] = None
         self.user: Optional[UserContext] = None
@@ -251,15 +341,14 @@ class RealtimeService:
         """
         logger.info("[STEP 1/5] Deconstructing payload and fetching tenant...")
         try:
-            value = self.payload['entry'][0]['changes'][0]['value']
-            self.user_phone = value['contacts'][0]['wa_id']
-            self.user_message = value['messages'][0]['text']['body']
-            tenant_phone_id = value['metadata']['phone_number_id']
+            # One validated pass over the payload instead of re-indexing it in every step.
+            value = WhatsAppInbound.model_validate(self.payload).value
+            contact = value.contacts[0]
+            self.user_phone, self.user_name = contact.wa_id, contact.profile.name
+            self.user_message = value.messages[0].text.body
+            tenant_phone_id = value.metadata.phone_number_id
             
-            res = supabase.table('businesses').select('id, system_prompt, tenant_name, bio').eq('whatsapp_phone_number_id', tenant_phone_id).single().execute()
-            
-            # The Pydantic model validates the structure of the response data.
-            self.tenant = tenantContext(**res.data)
+            self.tenant = self._get_tenant(tenant_phone_id)
             logger.info(f"[STEP 1/5] Success. Operating for tenant ID: {self.tenant.id}")
             return True
         except Exception as e:
@@ -268,10 +357,25 @@ class RealtimeService:
             return False
 
 
+    @staticmethod
+    def _get_tenant(tenant_phone_id: str) -> tenantContext:
+        with _tenant_cache_lock:
+            tenant = _tenant_by_phone_id.get(tenant_phone_id)
+        if tenant:
+            return tenant
+
+        res = supabase.table('businesses').select('id, system_prompt, tenant_name, bio').eq('whatsapp_phone_number_id', tenant_phone_id).single().execute()
+        
+        # The Pydantic model validates the structure of the response data.
+        tenant = tenantContext(**res.data)
+        with _tenant_cache_lock:
+            _tenant_by_phone_id[tenant_phone_id] = tenant
+        return tenant
+
     def _fetch_or_create_user(self) -> bool:
         """
-        Step 2: Finds an existing user or creates a new one.
-        This method is now robust and uses the correct Python library patterns.
+        Step 2: Finds an existing user or creates a new one, and loads their
+        conversation history and long-term memory in the same round-trip.
         """
         if not self.tenant or not self.user_phone:
             logger.error("[STEP 2/5] FAILED: Cannot fetch user without tenant or user phone.")
@@ -280,51 +384,48 @@ class RealtimeService:
         logger.info(f"[STEP 2/5] Finding or creating user for phone: {self.user_phone}")
         
         try:
-            # 1. Try to find an existing user first.
-            find_res = supabase.table('users') \
-                .select('id, user_name') \
-                .eq('business_id', self.tenant.id) \
-                .eq('phone_number', self.user_phone) \
-                .limit(1) \
-                .execute()
-
-            # The response for a query will always have a .data attribute, which is a list.
-            if find_res.data:
-                # User exists.
-                user_data = find_res.data[0]
-                logger.info(f"DEBUG: Data from DB to be validated by Pydantic: {user_data}")
+            # One round-trip for the user, their latest turns (oldest-first) and their memory.
+            # The user upsert has no gap between a SELECT and an INSERT for two messages from
+            # a new user to race through; the no-op DO UPDATE makes RETURNING yield an
+            # existing row as well. History is an index range scan, not a sort:
+            # CREATE INDEX CONCURRENTLY conversations_user_created_idx
+            #   ON conversations (user_id, created_at DESC) INCLUDE (role, content);
+            # CREATE FUNCTION begin_realtime_task(p_business_id uuid, p_phone text, p_name text,
+            #                                     p_history_limit int, p_memory_limit int)
+            # RETURNS jsonb AS $$
+            # DECLARE v_user users%ROWTYPE;
+            # BEGIN
+            #   INSERT INTO users (business_id, phone_number, user_name)
+            #   VALUES (p_business_id, p_phone, p_name)
+            #   ON CONFLICT (business_id, phone_number) DO UPDATE SET phone_number = EXCLUDED.phone_number
+            #   RETURNING * INTO v_user;
+            #   RETURN jsonb_build_object(
+            #     'user', jsonb_build_object('id', v_user.id, 'user_name', v_user.user_name),
+            #     'history', COALESCE((
+            #       SELECT jsonb_agg(jsonb_build_object('role', role, 'content', content) ORDER BY created_at)
+            #       FROM (SELECT role, content, created_at FROM conversations WHERE user_id = v_user.id
+            #             ORDER BY created_at DESC LIMIT p_history_limit) recent), '[]'::jsonb),
+            #     'memory', COALESCE((
+            #       SELECT jsonb_agg(jsonb_build_object('fact_key', fact_key, 'fact_value', fact_value))
+            #       FROM (SELECT fact_key, fact_value FROM user_memory WHERE user_id = v_user.id
+            #             LIMIT p_memory_limit) facts), '[]'::jsonb));
+            # END;
+            # $$ LANGUAGE plpgsql;
+            res = supabase.rpc('begin_realtime_task', {
+                'p_business_id': str(self.tenant.id), 'p_phone': self.user_phone, 'p_name': self.user_name,
+                'p_history_limit': HISTORY_TURNS, 'p_memory_limit': MEMORY_FACTS
+            }).execute()
+
+            user_data = res.data['user']
+            if Config.DEV_MODE:
                 self.user = UserContext(**user_data)
-                logger.info(f"[STEP 2/5] Found existing user ID: {self.user.id}")
-                return True
             else:
-                # 2. User does not exist. Create them.
-                user_name_from_payload = self.payload['entry'][0]['changes'][0]['value']['contacts'][0]['profile']['name']
-                logger.info(f"[STEP 2/5] New user detected. Creating record for '{user_name_from_payload}'.")
-                
-                insert_data = {
-                    "business_id": str(self.tenant.id),
-                    "phone_number": self.user_phone,
-                    "user_name": user_name_from_payload
-                }
-                
-                # Execute the insert. The Python library for v1/sync does not support
-                # chaining .select() after .insert(). We must do it in two steps.
-                # We also don't need the returned data from the insert itself.
-                supabase.table('users').insert(insert_data).execute()
-
-                # 3. Now that the user is created, fetch their new record to get the UUID.
-                # This is the guaranteed way to get the correct data.
-                refetch_res = supabase.table('users') \
-                    .select('id, user_name') \
-                    .eq('business_id', self.tenant.id) \
-                    .eq('phone_number', self.user_phone) \
-                    .single() \
-                    .execute()
-
-                # Now we can safely create our Pydantic model.
-                self.user = UserContext(**refetch_res.data)
-                logger.info(f"[STEP 2/5] Successfully created and fetched new user ID: {self.user.id}")
-                return True
+                # The RPC's column types already match the model; skip per-field validation.
+                self.user = UserContext.model_construct(id=UUID(user_data['id']), user_name=user_data['user_name'])
+            self.context.history = res.data['history']
+            self.context.long_term_memory = res.data['memory']
+            logger.info(f"[STEP 2/5] Operating for user ID: {self.user.id}")
+            return True
 
         except Exception as e:
             # This will catch any Postgrest APIError or other exceptions.
@@ -333,35 +434,26 @@ class RealtimeService:
 
     def _gather_context(self):
         """
-        Step 3: Gathers all available context for the LLM.
-        This method is designed to be resilient and will simply result in empty
-        context lists if any part fails.
+        Step 3: Gathers the remaining context for the LLM. History and memory already
+        came back with the user in Step 2; this adds the RAG knowledge, and is designed
+        to be resilient: if it fails, the context simply has no knowledge chunks.
         """
         if not self.tenant: return # Cannot proceed without a tenant context
 
         logger.info("[STEP 3/5] Gathering context for LLM...")
-        
-        # A) Short-term history (only if a user exists)
-        if self.user:
-            history_res = supabase.table('conversations').select('role, content').eq('user_id', self.user.id).order('created_at', desc=True).limit(20).execute()
-            logger.info(f"Cuatomer history response from supabase: {history_res}")
-            self.context.history = list(reversed(history_res.data)) if history_res.data else []
-
-        # B) Long-term memory (only if a user exists)
-        if self.user:
-            memory_res = supabase.table('user_memory').select('fact_key, fact_value').eq('user_id', self.user.id).limit(10).execute()
-            self.context.long_term_memory = memory_res.data or []
-
-        # C) RAG Knowledge (always attempt this)
+
+        # RAG Knowledge (always attempt this)
         try:
             if self.user_message:
-                refined_query = query_service.refine_user_query(raw_user_message=self.user_message, tenant_name=self.tenant.tenant_name, tenant_bio=self.tenant.bio, conversation_history=self.context.history, tenant_prompt=self.tenant.system_prompt )
-                embedding = openai_service.get_embedding(refined_query)
-                rag_res = supabase.rpc('match_knowledge', {'query_embedding': embedding, 'p_business_id': str(self.tenant.id), 'match_threshold': 0.2, 'match_count': 5}).execute()
-                logger.info(f"------------------------------------------------------------------------")
-                logger.info(f"rag knowledge res: {rag_res}")
-                logger.info(f"------------------------------------------------------------------------")
-                self.context.rag_knowledge = [item['content'] for item in (rag_res.data or [])]
+                refined_query = query_service.refine_user_query(tenant_id=self.tenant.id, raw_user_message=self.user_message, tenant_name=self.tenant.tenant_name, tenant_bio=self.tenant.bio, conversation_history=self.context.history, tenant_prompt=self.tenant.system_prompt )
+                cache_key = (self.tenant.id, hashlib.blake2b(refined_query.encode(), digest_size=16).digest())
+                with _rag_cache_lock:
+                    rag_knowledge = _rag_cache.get(cache_key)
+                if rag_knowledge is None:
+                    rag_knowledge = self._match_knowledge(refined_query)
+                    with _rag_cache_lock:
+                        _rag_cache[cache_key] = rag_knowledge
+                self.context.rag_knowledge = rag_knowledge
             else:
                 logger.warning(f"Could not fetch RAG knowledge. Proceeding without it. self.user_message is None")
                 
@@ -370,61 +462,58 @@ class RealtimeService:
 
         logger.info(f"Context gathered: {len(self.context.history)} history, {len(self.context.long_term_memory)} memory, {len(self.context.rag_knowledge)} RAG chunks.")
 
+    def _match_knowledge(self, refined_query: str) -> List[str]:
+        query_embedding = openai_service.get_query_embedding(refined_query)
+        # knowledge.embedding is stored as halfvec, which halves the HNSW index and
+        # roughly doubles match throughput:
+        # ALTER TABLE knowledge ALTER COLUMN embedding TYPE halfvec(1536) USING embedding::halfvec(1536);
+        # CREATE INDEX ON knowledge USING hnsw (embedding halfvec_cosine_ops);
+        # (match_knowledge takes query_embedding halfvec(1536).)
+        rag_res = supabase.rpc('match_knowledge', {'query_embedding': query_embedding, 'p_business_id': str(self.tenant.id), 'match_threshold': 0.2, 'match_count': 5}).execute()
+        logger.info(f"------------------------------------------------------------------------")
+        logger.info(f"rag knowledge res: {rag_res}")
+        logger.info(f"------------------------------------------------------------------------")
+        return [item['content'] for item in (rag_res.data or [])]
+
+    def _static_prompt_prefix(self) -> str:
+        """The identity, core rules and tenant persona: the part of the prompt that only changes per tenant."""
+        return _build_static_prefix(self.tenant.id, self.tenant.tenant_name, self.tenant.system_prompt)
+
     def _get_llm_action_plan(self) -> ActionPlan | None:	
         """Step 4: Constructs the prompt and calls Gemini to get a structured action plan."""
         if not self.tenant: return None
         logger.info("[STEP 4/5] Calling Gemini for unified action plan...")
         
-        # We use .model_dump() to safely serialize our Pydantic models for the prompt
-        prompt = f"""{self.tenant.system_prompt}
-
-        **Relevant Long-Term Memory about this User:**
-        {json.dumps(self.context.long_term_memory)}
-
-        **Relevant tenant Information & FAQs:**
-        {json.dumps(self.context.rag_knowledge)}
-
-        **Recent Conversation History:**
-        {json.dumps(self.context.history)}
-
-        **User's Latest Message:**
-        "{self.user_message}"
-
-        **Your Task:**
-        ... (rest of the detailed prompt is the same) ...
-        """
-        
-								# Level 2: The tenant-specific persona prompt from the DB
-        tenant_persona_prompt = self.tenant.system_prompt
-        tenant_name = self.tenant # Assuming this field exists from our pydantic model
-        
-								# Assemble the final prompt using our layered approach
-        prompt = f"""
-        **Your Identity:** Your name is Astro. You are an user assistant representing {	self.tenant.tenant_name	}.
-
-        {SYSTEM_CORE_PROMPT}
-
-        ---
-        **tenant-SPECIFIC STYLE GUIDELINES (Adopt this tone):**
-        {tenant_persona_prompt}
-        ---
-
+        # Everything that is identical across this tenant's messages goes first, so the
+        # provider can reuse the prefix between requests; per-message context follows.
+        prompt = self._static_prompt_prefix() + f"""
         **CONTEXT (Your ONLY source of truth):**
-        - Long-Term Memory: {json.dumps(self.context.long_term_memory)}
-        - tenant FAQs & Knowledge: {json.dumps(self.context.rag_knowledge)}
+        - Long-Term Memory: {_dumps(_select_memory(self.context.long_term_memory, self.user_message))}
+        - tenant FAQs & Knowledge: {_dumps(self.context.rag_knowledge)}
 
         **CONVERSATION HISTORY:**
-        {json.dumps(self.context.history)}
+        {_dumps(_compact_history(self.context.history))}
 
         **USER'S LATEST MESSAGE:**
         "{self.user_message}"
         
         """
         
+        cache_key = hashlib.sha256(prompt.encode()).digest()
+        with _action_plan_cache_lock:
+            cached_plan = _action_plan_cache.get(cache_key)
+        if cached_plan:
+            logger.info("[STEP 4/5] Reusing the action plan of an identical prompt.")
+            return cached_plan
+
         action_plan_object = gemini_service.think_and_generate_json(prompt=prompt, response_schema=ActionPlan)
         if not action_plan_object:
               logger.error("LLM (Schema Mode) failed to generate a valid action plan object.")
               return None
+
+        if not action_plan_object.tool_calls:
+            with _action_plan_cache_lock:
+                _action_plan_cache[cache_key] = action_plan_object
         
         logger.info(f"LLM returned valid action plan object: {action_plan_object}")
         return action_plan_object
@@ -442,6 +531,7 @@ class RealtimeService:
         tool_calls = action_plan.tool_calls
 
         # Respond First
+        outbound_event = None
         if response_text:
             whatsapp_payload = {
                 "messaging_product": "whatsapp",
@@ -450,20 +540,42 @@ class RealtimeService:
                 "text": {"body": response_text},
             }
             outbound_event = {"event_type": "send_outbound_message", "payload": {"data": whatsapp_payload, "config": {"channel": "whatsapp", "tenant_id": str(self.tenant.id)}}}
-            supabase.table('event_dispatcher').insert(outbound_event).execute()
-            logger.info(f"Queued outbound message for {self.user_phone}.")
 
         # Then queue background tasks
+        profiling_tasks = []
         for tool_call in tool_calls:
             if tool_call.name == "queue_for_profiling":
                 if not self.user:
                     logger.warning("Cannot queue for profiling as user object does not exist.")
                     continue
-                profiling_task = {"event_type": "run_profiling_analysis", "payload": { "user_id": str(self.user.id), "tenant_id": str(self.tenant.id), "summary": tool_call.arguments.summary_of_new_info, "full_conversation": self.context.history + [{"role": "user", "content": self.user_message}]}}
-                supabase.table('profiling_tasks').insert(profiling_task).execute()
-                logger.info(f"Queued task for profiling user {self.user.id}.")
+                profiling_tasks.append({"event_type": "run_profiling_analysis", "payload": { "user_id": str(self.user.id), "tenant_id": str(self.tenant.id), "summary": tool_call.arguments.summary_of_new_info, "full_conversation": self.context.history + [{"role": "user", "content": self.user_message}]}})
         
         # Save conversation to DB (only if user exists)
+        db_entries = []
         if self.user and response_text:
             db_entries = [{'user_id': str(self.user.id), 'role': 'user', 'content': self.user_message}, {'user_id': str(self.user.id), 'role': 'assistant', 'content': response_text}]
-            supabase.table('conversations').insert(db_entries).execute()
\ No newline at end of file
+
+        if not (outbound_event or profiling_tasks or db_entries):
+            return
+
+        # All of the task's writes in one round-trip and one transaction:
+        # CREATE FUNCTION finalize_task(p_outbound jsonb, p_profiling jsonb, p_conversations jsonb)
+        # RETURNS void AS $$
+        # BEGIN
+        #   IF p_outbound IS NOT NULL THEN
+        #     INSERT INTO event_dispatcher (event_type, payload)
+        #     VALUES (p_outbound->>'event_type', p_outbound->'payload');
+        #   END IF;
+        #   INSERT INTO profiling_tasks (event_type, payload)
+        #   SELECT t->>'event_type', t->'payload' FROM jsonb_array_elements(p_profiling) t;
+        #   INSERT INTO conversations (user_id, role, content)
+        #   SELECT (c->>'user_id')::uuid, c->>'role', c->>'content' FROM jsonb_array_elements(p_conversations) c;
+        # END;
+        # $$ LANGUAGE plpgsql;
+        supabase.rpc('finalize_task', {
+            'p_outbound': outbound_event, 'p_profiling': profiling_tasks, 'p_conversations': db_entries
+        }).execute()
+        if outbound_event:
+            logger.info(f"Queued outbound message for {self.user_phone}.")
+        if profiling_tasks:
+            logger.info(f"Queued task for profiling user {self.user.id}.")
@@ -4,31 +4,80 @@ import logging
 import json
 import numpy as np
 from uuid import UUID
-from sklearn.metrics.pairwise import cosine_similarity
+from concurrent.futures import ThreadPoolExecutor
 from ..db import supabase
 from . import openai_service, gemini_service
 from deprecated import deprecated
 
 logger = logging.getLogger(__name__)
 
+# Used to overlap independent DB reads with the slower AI phases.
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tagging")
+# Menu ingestion's per-item suggestion calls get their own pool, so a large menu can't
+# queue a concurrent create_product's prefetch behind dozens of Gemini calls.
+_batch_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tagging-batch")
+
 # --- Main Orchestration Function ---
-def suggest_and_reconcile_tags(tenant_id: UUID, product_name: str, product_description: str, product_embedding: list[float]) -> list[UUID]:
+def suggest_and_reconcile_tags(tenant_id: UUID, product_name: str, product_description: str, product_embedding: list[float]) -> list[str]:
     """Orchestrates the 3-phase intelligent tagging workflow."""
     
-    # Phase 1: Get candidates using pre-calculated embeddings
-    candidate_tags = _get_candidate_tags_by_vector(tenant_id, product_embedding)
+    # Phase 3's lookup of the tenant's existing tags doesn't depend on Phases 1-2,
+    # so start it now and let its round-trip overlap with the vector search + LLM call.
+    existing_tags_future = _executor.submit(_fetch_existing_tags_map, tenant_id)
 
-    # Phase 2: Use AI to review and refine
-    refined_tag_names = _get_ai_refined_tags(product_name, product_description, candidate_tags)
+    # Phases 1-2: Vector candidates, then AI review and refinement
+    refined_tag_names = _suggest_tag_names(tenant_id, product_name, product_description, product_embedding)
     if not refined_tag_names:
+        existing_tags_future.cancel()
         return []
 
     # Phase 3: Reconcile with DB, creating new tags (with embeddings) as needed
-    final_tag_ids = _reconcile_tags_in_db(tenant_id, refined_tag_names)
+    final_tag_ids = _reconcile_tags_in_db(tenant_id, refined_tag_names, existing_tags_future.result())
     return final_tag_ids
 
+
+def suggest_and_reconcile_tags_batch(tenant_id: UUID, products: list[tuple[str, str, list[float]]]) -> list[list[str] | None]:
+    """
+    The same workflow for many (product_name, product_description, product_embedding)
+    items at once, as used by menu ingestion. Phases 1-2 run per product, concurrently;
+    the tenant's existing tags are fetched once and Phase 3 runs once for the union of
+    all suggested names. Returns each product's tag IDs in input order, or None for a
+    product whose suggestion step failed.
+    """
+    existing_tags_future = _executor.submit(_fetch_existing_tags_map, tenant_id)
+    suggest_futures = [
+        _batch_executor.submit(_suggest_tag_names, tenant_id, product_name, product_description, product_embedding)
+        for product_name, product_description, product_embedding in products
+    ]
+
+    names_per_product = []
+    for (product_name, _, _), future in zip(products, suggest_futures):
+        try:
+            names_per_product.append([name.lower() for name in future.result()])
+        except Exception as e:
+            logger.error(f"Tagging: Failed to suggest tags for '{product_name}': {e}")
+            names_per_product.append(None)
+
+    # Phase 3, once: every distinct name across the menu, in first-seen order
+    all_names = list(dict.fromkeys(name for names in names_per_product if names for name in names))
+    existing_tags_map = existing_tags_future.result()
+    if all_names:
+        # Adds any tags it creates to existing_tags_map
+        _reconcile_tags_in_db(tenant_id, all_names, existing_tags_map)
+
+    return [
+        None if names is None else list({existing_tags_map[name] for name in names if name in existing_tags_map})
+        for names in names_per_product
+    ]
+
 # --- Private Helper Functions for Each Phase ---
 
+def _suggest_tag_names(tenant_id: UUID, product_name: str, product_description: str, product_embedding: list[float]) -> list[str]:
+    """PHASES 1-2: Vector-search candidate tags, then have the AI refine them into final names."""
+    candidate_tags = _get_candidate_tags_by_vector(tenant_id, product_embedding)
+    return _get_ai_refined_tags(product_name, product_description, candidate_tags)
+
+
 def _get_candidate_tags_by_vector(tenant_id: UUID, product_embedding: list[float], threshold: float = 0.30, limit: int = 10) -> list[dict]:
     """PHASE 1:  Uses the new DB function for efficient vector search."""
     logger.info("Tagging Phase 1: Using the DB function (match_tags) for search.")
@@ -89,49 +138,55 @@ def _get_ai_refined_tags(product_name: str, product_description: str, candidate_
         return []
 
 
-def _reconcile_tags_in_db(tenant_id: UUID, refined_names: list[str]) -> list[UUID]: # Removed candidate_tags dependency
+def _fetch_existing_tags_map(tenant_id: UUID) -> dict[str, str]:
+    """
+    Fetches ALL existing tags for the tenant just once to create a name -> id lookup map.
+    This is more efficient than querying the DB inside a loop.
+    """
+    existing_tags_res = supabase.table('product_tags').select('id, tag_name').eq('tenant_id', tenant_id).execute()
+    return {tag['tag_name']: tag['id'] for tag in (existing_tags_res.data or [])}
+
+
+def _reconcile_tags_in_db(tenant_id: UUID, refined_names: list[str], existing_tags_map: dict[str, str]) -> list[str]: # Removed candidate_tags dependency
     """
     PHASE 3 (Hardened): Takes the final list of names from the AI, checks if each one
-    exists in the DB, creates it if not, and returns all final UUIDs.
+    exists in the DB (via the prefetched map), creates it if not, and returns all final UUIDs.
     """
     logger.info(f"Tagging Phase 3: Reconciling {len(refined_names)} final tags with DB.")
     
-    # Fetch ALL existing tags for the tenant just once to create a lookup map.
-    # This is more efficient than querying the DB inside a loop.
-    existing_tags_res = supabase.table('product_tags').select('id, tag_name').eq('tenant_id', tenant_id).execute()
-    existing_tags_map = {tag['tag_name']: tag['id'] for tag in (existing_tags_res.data or [])}
-    
-    final_tag_ids = set()
-    
-    for name in refined_names:
-        name_lower = name.lower()
-        
-        # 1. Check if the tag already exists in our map
-        if name_lower in existing_tags_map:
-            final_tag_ids.add(existing_tags_map[name_lower])
-            logger.info(f"Tagging Phase 3: Found existing tag '{name_lower}'.")
-        else:
-            # 2. If it doesn't exist, it's genuinely new. Create it.
-            logger.info(f"Tagging Phase 3: Tag '{name_lower}' is new. Generating embedding and creating.")
-            try:
-                new_tag_embedding = openai_service.get_embedding(name_lower)
-                new_tag_data = {
-                    "tenant_id": str(tenant_id), 
-                    "tag_name": name_lower,
-                    "embedding": new_tag_embedding
-                }
-                new_tag_res = supabase.table('product_tags').insert(new_tag_data).execute()
-                
-                if new_tag_res.data:
-                    new_tag_id = new_tag_res.data[0]['id']
-                    final_tag_ids.add(new_tag_id)
-                    # Add to our map so we don't try to create it again in this same run
-                    existing_tags_map[name_lower] = new_tag_id 
-                else:
-                    # This could happen if there's a race condition, but we log it.
-                    logger.error(f"Tagging Phase 3: Failed to create new tag '{name_lower}'. Supabase error: {new_tag_res}")
-            except Exception as e:
-                logger.error(f"Tagging Phase 3: Exception while creating new tag '{name_lower}': {e}")
+    # Tag ids come back from PostgREST as UUID strings and are passed on as-is;
+    # only the tenant id needs converting, and only once.
+    tenant_id_str = str(tenant_id)
+
+    # 1. Split the normalized names into ones the prefetched map already has and new ones
+    refined_lower = {name.lower() for name in refined_names}
+    existing_names = refined_lower & existing_tags_map.keys()
+    new_names = list(refined_lower - existing_names)
+    final_tag_ids = {existing_tags_map[name] for name in existing_names}
+    if existing_names:
+        logger.info(f"Tagging Phase 3: Found existing tags {sorted(existing_names)}.")
+
+    # 2. Whatever is left is genuinely new: embed all of it in one call and create it in one upsert.
+    if new_names:
+        logger.info(f"Tagging Phase 3: Tags {new_names} are new. Generating embeddings and creating.")
+        try:
+            new_tag_embeddings = openai_service.get_batch_embeddings(new_names)
+            new_tags_data = [
+                {"tenant_id": tenant_id_str, "tag_name": name_lower, "embedding": embedding}
+                for name_lower, embedding in zip(new_names, new_tag_embeddings)
+            ]
+            # Upsert on the (tenant_id, tag_name) unique key: if a concurrent tagging run
+            # created the same tag a moment ago, we get its row back instead of a conflict.
+            new_tag_res = supabase.table('product_tags').upsert(new_tags_data, on_conflict='tenant_id,tag_name').execute()
+            
+            for row in new_tag_res.data or []:
+                final_tag_ids.add(row['id'])
+                # Add to our map so callers reusing it don't try to create it again
+                existing_tags_map[row['tag_name']] = row['id']
+            if len(new_tag_res.data or []) != len(new_names):
+                logger.error(f"Tagging Phase 3: Failed to create some of the new tags {new_names}. Supabase response: {new_tag_res}")
+        except Exception as e:
+            logger.error(f"Tagging Phase 3: Exception while creating new tags {new_names}: {e}")
 
     logger.info("Tagging Phase 3: Reconciliation complete.")
     return list(final_tag_ids)
@@ -159,9 +214,16 @@ def _get_candidate_tags_by_vector_python_side(tenant_id: UUID, product_embedding
     # We no longer need to call openai_service.get_batch_embeddings here.
     tag_embeddings = [tag['embedding'] for tag in existing_tags]
 
-    similarities = cosine_similarity(np.array([product_embedding]), np.array(tag_embeddings))[0]
+    # Cosine similarity as one float32 matrix-vector product over L2-normalized rows.
+    tag_matrix = np.asarray(tag_embeddings, dtype=np.float32)
+    tag_matrix /= np.linalg.norm(tag_matrix, axis=1, keepdims=True)
+    query = np.asarray(product_embedding, dtype=np.float32)
+    similarities = tag_matrix @ (query / np.linalg.norm(query))
     
-    top_indices = np.argsort(similarities)[-limit:][::-1]
+    # argpartition finds the top `limit` in O(N); only those few are then sorted.
+    limit = min(limit, len(similarities))
+    top_indices = np.argpartition(-similarities, limit - 1)[:limit]
+    top_indices = top_indices[np.argsort(-similarities[top_indices])]
     
     candidates = [existing_tags[i] for i in top_indices]
     
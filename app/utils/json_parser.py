@@ -1,23 +1,19 @@
-import json
 import logging
+import re
+import orjson
 
 logger = logging.getLogger(__name__)
 
-def safe_json_from_llm(llm_response_text: str, max_retries: int = 1) -> dict | None:
+# Markdown code fences (```json ... ``` or bare ```) around the JSON, plus surrounding whitespace.
+_FENCE_RE = re.compile(r'^\s*```(?:json)?\s*|\s*```\s*$')
+
+def safe_json_from_llm(llm_response_text: str) -> dict | None:
     """A resilient parser for JSON strings from LLMs."""
-    for attempt in range(max_retries + 1):
-        try:
-            # Most common error is markdown ```json ... ```
-            clean_text = llm_response_text.strip()
-            if clean_text.startswith('```json'):
-                clean_text = clean_text[7:]
-            if clean_text.endswith('```'):
-                clean_text = clean_text[:-3]
-            
-            return json.loads(clean_text)
-        except json.JSONDecodeError as e:
-            logger.warning(f"JSON Decode Error (Attempt {attempt + 1}): {e}. Raw text: '{llm_response_text}'")
-            if attempt >= max_retries:
-                # In a real system, you might make another LLM call here to fix the JSON
-                logger.error("All JSON parsing attempts failed.")
-                return None
\ No newline at end of file
+    try:
+        # Most common error is markdown ```json ... ```; strip it in one pass
+        return orjson.loads(_FENCE_RE.sub('', llm_response_text))
+    except orjson.JSONDecodeError as e:
+        # Parsing is deterministic, so retrying the same text can't help.
+        # In a real system, you might make another LLM call here to fix the JSON
+        logger.error(f"JSON Decode Error: {e}. Raw text: '{llm_response_text}'")
+        return None
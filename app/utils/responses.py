@@ -0,0 +1,11 @@
+# app/utils/responses.py
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+def row_response(row: dict, read_model: type[BaseModel], status_code: int = 200) -> ORJSONResponse:
+    """
+    Returns a row we just wrote, limited to the columns read_model exposes (so no
+    embeddings). The row came from a validated Create schema, so it is projected
+    rather than validated again on the way out.
+    """
+    return ORJSONResponse({field: row.get(field) for field in read_model.model_fields}, status_code=status_code)
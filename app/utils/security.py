@@ -3,6 +3,11 @@ import hmac
 import hashlib
 from ..config import Config
 
+# HMAC keyed with the App Secret once at import; each request copies it instead of
+# re-deriving the inner/outer key pads.
+_HMAC_TEMPLATE = hmac.new(Config.VERIFY_TOKEN.encode('utf-8'), digestmod=hashlib.sha256) if Config.VERIFY_TOKEN else None
+_SIGNATURE_PREFIX = 'sha256='
+
 def verify_whatsapp_signature(request_body: bytes, signature_header: str) -> bool:
     """
     Verifies the signature of an incoming WhatsApp webhook request.
@@ -11,21 +16,18 @@ def verify_whatsapp_signature(request_body: bytes, signature_header: str) -> boo
     :param signature_header: The value of the 'X-Hub-Signature-256' header.
     :return: True if the signature is valid, False otherwise.
     """
-    if not signature_header:
+    if not signature_header or _HMAC_TEMPLATE is None:
         return False
 
     # The header is in the format 'sha256=...'. We only need the part after the equals sign.
-    try:
-        signature_hash = signature_header.split('=')[1]
-    except IndexError:
+    if not signature_header.startswith(_SIGNATURE_PREFIX):
         return False
+    signature_hash = signature_header[len(_SIGNATURE_PREFIX):]
     
     # Calculate our own signature of the payload using the App Secret
-    expected_hash = hmac.new(
-        key=Config.VERIFY_TOKEN.encode('utf-8'),
-        msg=request_body,
-        digestmod=hashlib.sha256
-    ).hexdigest()
+    mac = _HMAC_TEMPLATE.copy()
+    mac.update(request_body)
+    expected_hash = mac.hexdigest()
 
     # Compare the two signatures in a way that is safe against timing attacks
     return hmac.compare_digest(signature_hash, expected_hash)	
\ No newline at end of file
@@ -1,135 +1,336 @@
 # worker.py
+import atexit
 import logging
+import os
+import queue
+import random
+import signal
 import time
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from app.db import supabase
 from app.logging_config import setup_logging
-from app.services.realtime_service import RealtimeService
+from app.services.realtime_service import RealtimeService, warm_tenant_cache
 from app.services import outbound_service # Import our new service
 from app.config import Config
+from app.api.schemas import ReadReceiptTask, OutboundTask
 
 # Configure logging for the worker process
 setup_logging()
 logger = logging.getLogger("worker")
 
+# Read receipts are cosmetic and must never hold up the reply pipeline behind them in
+# the realtime queue, so they are sent from this pool instead of the worker loop.
+_read_receipt_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="read-receipt")
+
+def _send_read_receipt(tenant_id, message_id):
+    try:
+        outbound_service.send_read_receipt_and_typing(tenant_id, message_id)
+    except Exception as e:
+        logger.error("REALTIME: Background read receipt for message %s failed: %s", message_id, e, exc_info=True)
+
+# Set by SIGTERM/SIGINT. The loops check it between polls and their waits return as soon
+# as it is set, so a shutdown never sits out a backoff.
+shutdown_event = threading.Event()
+
+class AdaptivePoller:
+    """
+    Decides how long a worker loop waits before its next poll. While rows keep coming
+    back it doesn't wait at all; once the queue is empty it starts with a short wait
+    (bursts tend to continue) and doubles it on every further empty poll, up to
+    max_interval, so an idle queue is polled no more often than before.
+
+    Failed polls count as empty ones until failure_threshold of them in a row; after
+    that the backend is treated as down and the wait grows to 2, 4, 8... seconds (up to
+    max_backoff, jittered so replicas don't retry in step). The next successful poll
+    resets it.
+    """
+    def __init__(self, min_interval: float = 0.1, max_interval: float = 2.0,
+                 failure_threshold: int = 5, max_backoff: float = 60.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.failure_threshold = failure_threshold
+        self.max_backoff = max_backoff
+        self._interval = 0.0
+        self._failures = 0
+
+    def got_work(self):
+        self._failures = 0
+        self._interval = 0.0
+
+    def idle(self):
+        self._failures = 0
+        self._interval = min(self.max_interval, max(self.min_interval, self._interval * 2))
+
+    def failed(self):
+        failures = self._failures + 1
+        if failures < self.failure_threshold:
+            self.idle()
+        else:
+            # Exponent capped: 2**16s is far past max_backoff, and an unbounded one would
+            # overflow the float multiply below after a long enough outage.
+            backoff = 2 ** min(failures - self.failure_threshold + 1, 16)
+            self._interval = min(self.max_backoff, backoff * random.uniform(0.5, 1.5))
+        self._failures = failures
+
+    def wait(self):
+        if self._interval:
+            shutdown_event.wait(self._interval)
+
+# Rows claimed per lock RPC. The dispatcher only routes, so it takes big batches; realtime
+# tasks are slow, so it takes fewer at a time and leaves the rest for other replicas.
+DISPATCH_BATCH_SIZE = 32
+REALTIME_BATCH_SIZE = 8
+
+# A batch's tasks are network-bound (Supabase, OpenAI, Gemini, Graph API), so they run side
+# by side; only tasks for the same conversation are kept in order (see _ordering_key).
+_realtime_executor = ThreadPoolExecutor(max_workers=REALTIME_BATCH_SIZE, thread_name_prefix="realtime-task")
+
 def dispatch_events():
     """Polls the event_dispatcher and routes events to specialized queues."""
     logger.info("Dispatcher worker started...")
-    while True:
+    poller = AdaptivePoller()
+    while not shutdown_event.is_set():
         try:
-            res = supabase.rpc('get_and_lock_dispatcher_event', {}).execute()
-            if res.data:
-                event = res.data[0]
-                event_id, event_type, payload = event['id'], event['event_type'], event['payload']
-                logger.info(f"DISPATCHER: Processing event {event_id} of type '{event_type}'")
-
-                # --- The Routing Logic ---
-                # --- NEW ROUTE FOR READ RECEIPTS ---
-                if event_type == 'send_read_receipt':
-                    # This is also a high-priority task.
-                    task = {"event_type": "execute_read_receipt", "payload": payload}
-                    supabase.table('realtime_tasks').insert(task).execute()
-                    logger.info(f"DISPATCHER: Event {event_id} dispatched to 'realtime_tasks' for read receipt.")
-
-                elif event_type == 'new_inbound_message':
-                    # All inbound messages go to the realtime queue first
-                    task = {"event_type": "handle_user_message", "payload": payload}
-                    supabase.table('realtime_tasks').insert(task).execute()
-                    logger.info(f"DISPATCHER: Event {event_id} dispatched to 'realtime_tasks'.")
-                
-                # --- NEW ROUTE FOR OUTBOUND MESSAGES ---
-                elif event_type == 'send_outbound_message':
-                    # Outbound messages are also high-priority, so they use the realtime queue.
-                    # We give it a different event_type so the realtime worker knows what to do.
-                    task = {"event_type": "execute_whatsapp_send", "payload": payload}
-                    supabase.table('realtime_tasks').insert(task).execute()
-                    logger.info(f"DISPATCHER: Event {event_id} dispatched to 'realtime_tasks' for sending.")
-
-                else:
-                    logger.warning(f"DISPATCHER: No route found for event type '{event_type}'. Marking as failed.")
-                    supabase.table('event_dispatcher').update({'status': 'failed'}).eq('id', event_id).execute()
+            # Routing is a fixed function of event_type, so it happens in the database: one
+            # round-trip and one transaction lock a batch, queue the routed realtime_tasks and
+            # settle the dispatcher rows, so no event is left locked but never routed.
+            # Queue order is an identity column: created_at is now(), which is the same for
+            # every row one transaction inserts, while seq numbers rows in insert order.
+            # ALTER TABLE event_dispatcher ADD COLUMN seq bigint GENERATED ALWAYS AS IDENTITY;
+            # ALTER TABLE realtime_tasks ADD COLUMN seq bigint GENERATED ALWAYS AS IDENTITY;
+            # CREATE INDEX CONCURRENTLY event_dispatcher_pending_idx
+            #   ON event_dispatcher (seq) WHERE status = 'pending';
+            # CREATE FUNCTION dispatch_and_route(p_batch_size int) RETURNS int AS $$
+            # DECLARE v_count int;
+            # BEGIN
+            #   WITH batch AS (
+            #     SELECT id, event_type, payload, seq FROM event_dispatcher WHERE status = 'pending'
+            #     ORDER BY seq LIMIT p_batch_size FOR UPDATE SKIP LOCKED
+            #   ), routed AS (
+            #     SELECT id, payload, seq, CASE event_type
+            #       WHEN 'send_read_receipt' THEN 'execute_read_receipt'
+            #       WHEN 'new_inbound_message' THEN 'handle_user_message'
+            #       WHEN 'send_outbound_message' THEN 'execute_whatsapp_send'
+            #     END AS task_type
+            #     FROM batch
+            #   ), queued AS (
+            #     INSERT INTO realtime_tasks (event_type, payload)
+            #     SELECT task_type, payload FROM routed WHERE task_type IS NOT NULL ORDER BY seq
+            #   )
+            #   UPDATE event_dispatcher d
+            #   SET status = CASE WHEN r.task_type IS NULL THEN 'failed' ELSE 'complete' END
+            #   FROM routed r WHERE d.id = r.id;
+            #   GET DIAGNOSTICS v_count = ROW_COUNT;
+            #   RETURN v_count;
+            # END;
+            # $$ LANGUAGE plpgsql;
+            res = supabase.rpc('dispatch_and_route', {'p_batch_size': DISPATCH_BATCH_SIZE}).execute()
+            dispatched = res.data or 0
+            if dispatched:
+                logger.info("DISPATCHER: Routed %s events.", dispatched)
 
         except Exception as e:
-            logger.error(f"Error in dispatcher loop: {e}", exc_info=True)
-        
-        time.sleep(2)
+            logger.error("Error in dispatcher loop: %s", e, exc_info=True)
+            poller.failed()
+        else:
+            # Drain a backlog back-to-back; only back off when the queue is empty.
+            if dispatched:
+                poller.got_work()
+            else:
+                poller.idle()
+        poller.wait()
+
+def _run_read_receipt(payload: dict):
+    # A missing or empty field raises a ValidationError naming it, failing the task
+    task = ReadReceiptTask.model_validate(payload)
+    
+    # Fire and forget: the next task (usually the reply itself) starts right away
+    _read_receipt_executor.submit(_send_read_receipt, task.tenant_id, task.message_id)
+
+def _run_realtime_service(payload: dict):
+    # The payload of the task IS the original dispatcher event payload.
+    service_instance = RealtimeService(task_payload=payload)
+    service_instance.run()
+
+def _run_whatsapp_send(payload: dict):
+    # The payload of the task IS the original dispatcher event payload.
+    task = OutboundTask.model_validate(payload)
+    
+    if task.config.channel == 'whatsapp':
+        outbound_service.send_whatsapp_message(tenant_id=task.config.tenant_id, message_payload=task.data)
+    else:
+        logger.warning("REALTIME: Outbound channel '%s' not supported yet.", task.config.channel)
+
+# realtime_tasks.event_type -> handler. New task types only need an entry here.
+REALTIME_HANDLERS = {
+    'execute_read_receipt': _run_read_receipt,
+    'handle_user_message': _run_realtime_service,
+    'execute_whatsapp_send': _run_whatsapp_send,
+}
+
+def _run_realtime_task(event_type: str, payload: dict):
+    """Runs one realtime task; raises if it can't be completed."""
+    handler = REALTIME_HANDLERS.get(event_type)
+    if handler is None:
+        # This will now correctly catch the 'None' case or any other unexpected type.
+        raise ValueError(f"Unknown event_type in realtime_tasks: {event_type}")
+    handler(payload)
 
-# In worker.py
+# Task outcomes are written by _status_writer, so the next task starts without waiting on
+# a status round-trip. Items are (task_id, status, last_error).
+_status_queue: queue.Queue = queue.Queue()
+STATUS_WRITE_BATCH = 64
+
+def _status_writer():
+    """Coalesces queued task outcomes: one update for all completions, one per failure."""
+    while True:
+        items = [_status_queue.get()]
+        while len(items) < STATUS_WRITE_BATCH:
+            try:
+                items.append(_status_queue.get_nowait())
+            except queue.Empty:
+                break
+        # Each write is tried on its own, so one failing update doesn't drop the others
+        completed_ids = [task_id for task_id, status, _ in items if status == 'complete']
+        if completed_ids:
+            try:
+                supabase.table('realtime_tasks').update({'status': 'complete'}).in_('id', completed_ids).execute()
+            except Exception as e:
+                logger.error("REALTIME: Could not mark tasks %s complete: %s", completed_ids, e, exc_info=True)
+        for task_id, status, last_error in items:
+            if status == 'failed':
+                try:
+                    supabase.table('realtime_tasks').update({'status': 'failed', 'last_error': last_error}).eq('id', task_id).execute()
+                except Exception as e:
+                    logger.error("REALTIME: Could not mark task %s failed: %s", task_id, e, exc_info=True)
+        for _ in items:
+            _status_queue.task_done()
+
+# Don't exit with outcomes still queued (the writer is a daemon thread).
+atexit.register(_status_queue.join)
+
+def _ordering_key(event_type: str, payload: dict):
+    """
+    Tasks with the same key must run in queue order (e.g. two messages from one user, or
+    two replies to them). None means the task can run alongside anything.
+    """
+    try:
+        if event_type == 'handle_user_message':
+            value = payload['entry'][0]['changes'][0]['value']
+            return ('conversation', value['metadata']['phone_number_id'], value['contacts'][0]['wa_id'])
+        if event_type == 'execute_whatsapp_send':
+            return ('send', payload['config']['tenant_id'], payload['data']['to'])
+    except (KeyError, IndexError, TypeError):
+        pass # A malformed payload fails on its own in _run_realtime_task
+    return None
+
+def _run_realtime_tasks_in_order(tasks: list[dict]):
+    """Runs tasks one after another, queueing each outcome for the status writer."""
+    for task in tasks:
+        task_id = task.get('id')
+        event_type = task.get('event_type')
+        payload = task.get('payload')
+
+        # Per-task lines are DEBUG: at INFO they dominate the log once traffic picks up
+        logger.debug("REALTIME: Processing task %s of type '%s'", task_id, event_type)
+
+        try:
+            _run_realtime_task(event_type, payload)
+            _status_queue.put((task_id, 'complete', None))
+            logger.debug("REALTIME: Task %s completed successfully.", task_id)
+        except Exception as task_error:
+            logger.error("REALTIME: Error processing task %s: %s", task_id, task_error, exc_info=True)
+            _status_queue.put((task_id, 'failed', str(task_error)))
 
 def process_realtime_tasks():
     """Polls the realtime_tasks queue and triggers the appropriate service."""
     logger.info("Realtime worker started...")
-    while True:
+    poller = AdaptivePoller()
+    while not shutdown_event.is_set():
         try:
-            res = supabase.rpc('get_and_lock_realtime_task', {}).execute()
-            
-            if res.data:
-                task = res.data[0]
-                
-                # THE FIX: Get the event_type from the task object itself.
-                task_id = task.get('id')
-                event_type = task.get('event_type')
-                payload = task.get('payload')
+            # Up to p_batch_size pending tasks per round-trip. SKIP LOCKED lets every replica
+            # claim its own rows at once instead of queueing on the same ones, and the partial
+            # index keeps the inner scan to pending rows however large the table grows:
+            # CREATE INDEX CONCURRENTLY realtime_tasks_pending_idx
+            #   ON realtime_tasks (seq) WHERE status = 'pending';
+            # CREATE FUNCTION get_and_lock_realtime_tasks(p_batch_size int)
+            # RETURNS SETOF realtime_tasks AS $$
+            #   WITH claimed AS (
+            #     UPDATE realtime_tasks SET status = 'processing', locked_at = now()
+            #     WHERE id IN (SELECT id FROM realtime_tasks WHERE status = 'pending'
+            #                  ORDER BY seq LIMIT p_batch_size FOR UPDATE SKIP LOCKED)
+            #     RETURNING *
+            #   )
+            #   -- RETURNING has no defined order; the lanes below rely on this one
+            #   SELECT * FROM claimed ORDER BY seq;
+            # $$ LANGUAGE sql;
+            res = supabase.rpc('get_and_lock_realtime_tasks', {'p_batch_size': REALTIME_BATCH_SIZE}).execute()
 
-                logger.info(f"REALTIME: Processing task {task_id} of type '{event_type}'")
+            # Group the batch into independent lanes. Rows arrive in queue order, so each
+            # lane's list is too.
+            lanes = {}
+            for task in res.data or []:
+                key = _ordering_key(task.get('event_type'), task.get('payload') or {})
+                lanes.setdefault(key if key is not None else ('task', task.get('id')), []).append(task)
 
-                try:
-                    # --- NEW LOGIC FOR READ RECEIPTS ---
-                    if event_type == 'execute_read_receipt':
-                        tenant_id = payload.get('tenant_id')
-                        message_id = payload.get('message_id')
-                        if not all([tenant_id, message_id]):
-                            raise ValueError("Missing tenant_id or message_id for read receipt.")
-                        
-                        outbound_service.send_read_receipt_and_typing(tenant_id, message_id)
-
-                    # THE FIX: Check against the correct task event types.
-                    elif event_type == 'handle_user_message':
-                        # The payload of the task IS the original dispatcher event payload.
-                        service_instance = RealtimeService(task_payload=payload)
-                        service_instance.run()
-                    
-                    elif event_type == 'execute_whatsapp_send':
-                        # The payload of the task IS the original dispatcher event payload.
-                        config = payload.get('config', {})
-                        
-                        tenant_id = config.get('tenant_id')
-                        channel = config.get('channel')
-                        message_payload = payload.get('data')
-                        
-                        if not all([tenant_id, channel, message_payload]):
-                            raise ValueError("Missing tenant_id, channel, or data payload for sending message.")
-                        
-                        if channel == 'whatsapp':
-                            outbound_service.send_whatsapp_message(tenant_id=tenant_id, message_payload=message_payload)
-                        else:
-                            logger.warning(f"REALTIME: Outbound channel '{channel}' not supported yet.")
-                            
-                    else:
-                        # This will now correctly catch the 'None' case or any other unexpected type.
-                        raise ValueError(f"Unknown event_type in realtime_tasks: {event_type}")
-
-                    supabase.table('realtime_tasks').update({'status': 'complete'}).eq('id', task_id).execute()
-                    logger.info(f"REALTIME: Task {task_id} completed successfully.")
-                except Exception as task_error:
-                    logger.error(f"REALTIME: Error processing task {task_id}: {task_error}", exc_info=True)
-                    supabase.table('realtime_tasks').update({'status': 'failed', 'last_error': str(task_error)}).eq('id', task_id).execute()
+            futures = [_realtime_executor.submit(_run_realtime_tasks_in_order, lane) for lane in lanes.values()]
+            for future in futures:
+                future.result()
         except Exception as e:
-            logger.error(f"Error in realtime worker loop: {e}", exc_info=True)
-        
-        time.sleep(2)
+            logger.error("Error in realtime worker loop: %s", e, exc_info=True)
+            poller.failed()
+        else:
+            if res.data:
+                poller.got_work()
+            else:
+                poller.idle()
+        poller.wait()
         
 # ... (profiling worker function can be defined here but not run yet) ...
+# "Profiling" here is user-interest profiling (profiling_tasks -> profiling_service), not
+# performance profiling; sample a live worker from outside with `py-spy top --pid <pid>`.
+
+# How long shutdown waits for a loop to finish the batch it is on (a reply can take a few
+# LLM round-trips) before exiting anyway. Tasks still running then stay in 'processing'.
+SHUTDOWN_TIMEOUT = 30.0
+
+def _request_shutdown(signum, frame):
+    logger.info("Received %s, shutting down...", signal.Signals(signum).name)
+    shutdown_event.set()
 
 if __name__ == "__main__":
-    import threading
-    logger.info(f"Starting workers in separate threads... DEV MODE: {Config.DEV_MODE}")
+    logger.info("Starting workers in separate threads... DEV MODE: %s", Config.DEV_MODE)
+
+    try:
+        warm_tenant_cache()
+    except Exception as e:
+        # Not fatal: RealtimeService._get_tenant falls back to a per-phone lookup on a miss.
+        logger.warning("Could not warm tenant cache: %s", e)
+    
+    dispatcher_thread = threading.Thread(target=dispatch_events, name="dispatcher", daemon=True)
+    realtime_thread = threading.Thread(target=process_realtime_tasks, name="realtime", daemon=True)
+    status_writer_thread = threading.Thread(target=_status_writer, name="status-writer", daemon=True)
     
-    dispatcher_thread = threading.Thread(target=dispatch_events, daemon=True)
-    realtime_thread = threading.Thread(target=process_realtime_tasks, daemon=True)
+    signal.signal(signal.SIGTERM, _request_shutdown)
+    signal.signal(signal.SIGINT, _request_shutdown)
     
+    status_writer_thread.start()
     dispatcher_thread.start()
     realtime_thread.start()
     
-    while True:
-        time.sleep(1)
\ No newline at end of file
+    shutdown_event.wait()
+    
+    # Let the loops finish their current batch; queued statuses are flushed at exit.
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    for thread in (dispatcher_thread, realtime_thread):
+        thread.join(timeout=max(0.0, deadline - time.monotonic()))
+    stuck = [thread.name for thread in (dispatcher_thread, realtime_thread) if thread.is_alive()]
+    if stuck:
+        logger.warning("%s did not stop within %ss; exiting anyway. Their in-flight tasks stay in 'processing'.", stuck, SHUTDOWN_TIMEOUT)
+        _realtime_executor.shutdown(wait=False, cancel_futures=True)
+        _status_queue.join()
+        # The executor's threads are non-daemon and the interpreter joins them on a normal
+        # exit, which would wait out whatever call they are stuck in.
+        os._exit(1)
+    logger.info("Workers stopped.")